@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from main import Thermostat
+from settings_handler import default_settings, parent_directory
+
+
+def _timed(func, durations):
+    @functools.wraps(func)
+    async def wrapper():
+        start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - start)
+    return wrapper
+
+
+def _settings(directory, acceleration):
+    '''
+    default_settings on the simulated backend, without cloud,
+    every file inside directory, intervals shortened by acceleration.
+    '''
+    settings = json.loads(json.dumps(default_settings))
+    settings["paths"].update({
+        "daily_log": os.path.join(directory, "log.jsonl"),
+        "program": os.path.join(directory, "program.json"),
+        "timeseries": os.path.join(directory, "timeseries"),
+        "outbox": os.path.join(directory, "outbox.json"),
+        "snapshot": os.path.join(directory, "state.bin"),
+    })
+    settings["configs"].update({"backend": "simulated", "cloud": False})
+    settings["api"]["enabled"] = False
+    settings["mode"].update({"manual": True, "desired_temp": 20})
+    settings["intervals"] = {
+        k: v / acceleration for k, v in settings["intervals"].items()
+    }
+    settings["log"]["loglevel"] = "WARNING"
+    return settings
+
+
+def run(duration, acceleration):
+    '''
+    Runs Thermostat.loop on the simulated backend for duration seconds,
+    with simulated time running acceleration times faster.
+    Returns durations (seconds) of every run of each task.
+    '''
+    directory = tempfile.mkdtemp(prefix='thermostat-benchmark-')
+    try:
+        shutil.copy(
+            os.path.join(parent_directory, "examples", "example_program.json"),
+            directory
+        )
+        settings_path = os.path.join(directory, "settings.json")
+        with open(settings_path, "w") as f:
+            json.dump(_settings(directory, acceleration), f)
+        exit = threading.Event()
+        thermostat = Thermostat(exit, settings_path)
+        thermostat.room.acceleration = acceleration
+        durations = {}
+        for task in (
+            "_poll_sensor",
+            "_control",
+            "_watch_files",
+            "_persist",
+            "_sync",
+            "_flush_timeseries"
+        ):
+            durations[task] = []
+            setattr(thermostat, task, _timed(
+                getattr(thermostat, task), durations[task]
+            ))
+        threading.Timer(duration, exit.set).start()
+        asyncio.run(thermostat.loop())
+        return durations, thermostat.room
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Benchmarks the thermostat loop on simulated hardware.'
+        )
+    )
+    parser.add_argument(
+        '-d', '--duration', type=float, default=10,
+        help='Seconds of real time to run for.'
+    )
+    parser.add_argument(
+        '-a', '--acceleration', type=float, default=100,
+        help='How much faster than real time the simulation runs.'
+    )
+    args = parser.parse_args()
+    durations, room = run(args.duration, args.acceleration)
+    for task, task_durations in durations.items():
+        if not task_durations:
+            continue
+        task_durations.sort()
+        print(
+            '{:<18} runs: {:>7}  mean: {:8.1f} us  p50: {:8.1f} us'
+            '  p99: {:8.1f} us'.format(
+                task,
+                len(task_durations),
+                statistics.mean(task_durations) * 1e6,
+                task_durations[len(task_durations) // 2] * 1e6,
+                task_durations[int(len(task_durations) * 0.99)] * 1e6
+            )
+        )
+    print('Final room temperature: {:.2f}'.format(room.temperature))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+import collections
+import logging
+
+import util
+
+
+logger_name = 'thermostat.control'
+logger = logging.getLogger(logger_name)
+
+
+class BangBang():
+    """
+    On below the target, off above it, with a hysteresis band:
+    an idle heater turns on below target - below, a running one
+    turns off from target + above.
+    With no band this is the plain room < target comparison.
+    """
+
+    def __init__(self, below=0.0, above=0.0):
+        self.below = below
+        self.above = above
+
+    def threshold(self, target, heating):
+        """Room temperature at which the heater switches."""
+        return target + self.above if heating else target - self.below
+
+    def decide(self, now, room_temperature, target, heating):
+        return room_temperature < self.threshold(target, heating), None
+
+    def reset(self):
+        pass
+
+
+class TimeProportional():
+    """
+    Heater on for a fraction (duty) of every period seconds:
+    the whole period when the room is band degrees or more below
+    target, never when it's at target or above.
+    The duty is computed at the start of each cycle, a new one
+    starts right away if the target changes.
+    """
+
+    def __init__(self, period=900, band=1.0):
+        self.period = period
+        self.band = band
+        self.reset()
+
+    def reset(self):
+        self.cycle_start = None
+        self.cycle_target = None
+        self.on_for = 0
+
+    def duty(self, error, elapsed):
+        """Fraction of the period to heat for, given how far below
+        target the room is and seconds since the previous cycle."""
+        return min(max(error / self.band, 0.0), 1.0)
+
+    def decide(self, now, room_temperature, target, heating):
+        if (
+            self.cycle_start is None
+            or now >= self.cycle_start + self.period
+            or target != self.cycle_target
+        ):
+            elapsed = (
+                self.period if self.cycle_start is None
+                else now - self.cycle_start
+            )
+            self.cycle_start = now
+            self.cycle_target = target
+            self.on_for = self.duty(target - room_temperature, elapsed) * (
+                self.period
+            )
+        on_until = self.cycle_start + self.on_for
+        if now < on_until:
+            return True, on_until
+        return False, self.cycle_start + self.period
+
+
+class PI(TimeProportional):
+    """
+    Time-proportional heating with the duty from a proportional
+    integral controller, which removes the offset left by
+    TimeProportional: kp is duty per degree below target,
+    ki duty per degree hour accumulated.
+    The integral doesn't grow while the duty is saturated.
+    """
+
+    def __init__(self, period=900, kp=0.5, ki=0.5):
+        self.kp = kp
+        self.ki = ki
+        super().__init__(period)
+
+    def reset(self):
+        super().reset()
+        self.integral = 0.0
+
+    def duty(self, error, elapsed):
+        integral = self.integral + error * elapsed / 3600
+        output = self.kp * error + self.ki * integral
+        if 0.0 < output < 1.0 or (output >= 1.0) != (error > 0):
+            self.integral = integral
+        return min(max(self.kp * error + self.ki * self.integral, 0.0), 1.0)
+
+
+strategies = {
+    'bang_bang': BangBang,
+    'time_proportional': TimeProportional,
+    'pi': PI,
+}
+
+
+class ControlEngine():
+    """
+    Turns strategy decisions into relay states protecting the boiler:
+    the relay stays on at least min_on seconds and off at least
+    min_off seconds after each switch, and never turns on more than
+    max_cycles_per_hour times in an hour.
+    Times are epoch seconds (util.clock.time()).
+    """
+
+    def __init__(
+        self,
+        strategy=None,
+        min_on=0,
+        min_off=0,
+        max_cycles_per_hour=None
+    ):
+        self.strategy = strategy if strategy is not None else BangBang()
+        self.min_on = min_on
+        self.min_off = min_off
+        self.max_cycles_per_hour = max_cycles_per_hour
+        # time of the last relay switch, None if free to switch
+        self.last_switch = None
+        # times the relay turned on in the last hour
+        self.starts = collections.deque()
+
+    def decide(self, now, room_temperature, target, heating):
+        """
+        Returns (on, wake_at): whether the heater should be on and,
+        when the decision holds for a known time, when to decide
+        again, None if only temperature changes can change it.
+        target None means the heater must be off.
+        """
+        if target is None:
+            self.strategy.reset()
+            wanted, until = False, None
+        else:
+            wanted, until = self.strategy.decide(
+                now, room_temperature, target, heating
+            )
+        if wanted == heating:
+            return heating, until
+        locked_until = self.locked_until(now, heating)
+        if locked_until is not None:
+            # the strategy may have something to do before, e.g.
+            # start a new cycle
+            if until is not None:
+                locked_until = min(locked_until, until)
+            return heating, locked_until
+        return wanted, until
+
+    def locked_until(self, now, heating):
+        """
+        When the relay can switch again, None if it can now.
+        Like the former stop_time, a switch is allowed only when
+        strictly more than min_on or min_off seconds have passed.
+        """
+        if self.last_switch is not None:
+            hold = self.min_on if heating else self.min_off
+            if now - self.last_switch <= hold:
+                return self.last_switch + hold
+        if not heating and self.max_cycles_per_hour:
+            while self.starts and now - self.starts[0] >= 3600:
+                self.starts.popleft()
+            if len(self.starts) >= self.max_cycles_per_hour:
+                return self.starts[0] + 3600
+        return None
+
+    def switched(self, now, on):
+        """Records that the relay switched at now."""
+        self.last_switch = now
+        if on:
+            self.starts.append(now)
+
+    def release(self):
+        """Lifts the minimum on/off times, e.g. when the user
+        changes mode or temperature."""
+        self.last_switch = None
+
+
+def engine_from_settings(configs, stop_time, previous=None):
+    """
+    ControlEngine from settings["control"]. min_on and min_off
+    default to stop_time. Switch history is taken from previous.
+    """
+    strategy_name = configs["strategy"]
+    if strategy_name not in strategies:
+        raise ValueError('Unknown control strategy: {}'.format(strategy_name))
+    if strategy_name == 'bang_bang':
+        strategy = BangBang(*configs["hysteresis"])
+    elif strategy_name == 'time_proportional':
+        strategy = TimeProportional(configs["period"], configs["band"])
+    else:
+        strategy = PI(configs["period"], configs["kp"], configs["ki"])
+    engine = ControlEngine(
+        strategy,
+        stop_time if configs["min_on"] is None else configs["min_on"],
+        stop_time if configs["min_off"] is None else configs["min_off"],
+        configs["max_cycles_per_hour"]
+    )
+    if previous is not None:
+        engine.last_switch = previous.last_switch
+        engine.starts = previous.starts
+    return engine
+
+
+def target_temperature(
+    manual,
+    auto,
+    program_target_temperature,
+    desired_temp
+):
+    """Temperature the heater is aiming at, None when it's off.
+    Manual mode prevails over auto mode and so does desired_temp
+    over True values in program.json."""
+    if manual:
+        return desired_temp
+    if auto:
+        if program_target_temperature is True:
+            return desired_temp
+        if (
+            program_target_temperature is not False
+            and util.is_number(program_target_temperature)
+        ):
+            return program_target_temperature
+    return None
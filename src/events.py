@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import asyncio
+import collections
+import logging
+
+
+logger_name = 'thermostat.events'
+logger = logging.getLogger(logger_name)
+
+# kinds of events published by the thermostat
+SENSOR = 'sensor'      # room temperature changed
+COMMAND = 'command'    # command from iottly or local APIs
+SCHEDULE = 'schedule'  # program slot boundary or end of a stop
+FILE = 'file'          # settings or program edited from outside
+kinds = (SENSOR, COMMAND, SCHEDULE, FILE)
+
+
+class EventBus():
+    '''
+    Delivers events to callbacks inside the event loop.
+
+    publish can be called from any thread (iottly callbacks run
+    in their own threads): callbacks always run in the loop thread,
+    so they can touch the loop's state without locks.
+    Events published before the bus is attached to a loop are dropped.
+    '''
+
+    def __init__(self):
+        self.subscribers = collections.defaultdict(list)
+        # events delivered so far, by kind
+        self.counts = collections.Counter()
+        self._loop = None
+
+    def attach(self, loop):
+        self._loop = loop
+
+    def detach(self):
+        self._loop = None
+
+    def subscribe(self, kind, callback):
+        '''
+        Calls callback(kind, data) at every event of given kind.
+        '''
+        self.subscribers[kind].append(callback)
+
+    def publish(self, kind, **data):
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(kind, data)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, kind, data)
+
+    def publish_later(self, delay, kind, **data):
+        '''
+        Publishes an event after delay seconds.
+        To be called from the loop thread.
+        Returns a handle with a cancel() method, None if not attached.
+        '''
+        if self._loop is None:
+            return None
+        return self._loop.call_later(
+            delay, self._dispatch, kind, data
+        )
+
+    def _dispatch(self, kind, data):
+        self.counts[kind] += 1
+        logger.debug('Event %s: %s', kind, data)
+        for callback in self.subscribers[kind]:
+            try:
+                callback(kind, data)
+            except Exception:
+                logger.exception('Error handling {} event.'.format(kind))
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from exceptions import ThermometerLocalTimeout
+from thermometer import ThermometerLocal
+
+
+class FakeThermometerProtocol(asyncio.DatagramProtocol):
+    """
+    Replies to every datagram like udp_sketch.ino does,
+    with {"celsius": ...}, echoing the request's sequence number.
+    Replies can be delayed and dropped to emulate a flaky sensor.
+    """
+
+    def __init__(self, celsius=20.0, delay=0, drop=0, legacy=False):
+        self.celsius = celsius
+        self.delay = delay
+        self.drop = drop
+        # reply without sequence number, like older sketches
+        self.legacy = legacy
+        self.requests = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.requests += 1
+        if random.random() < self.drop:
+            return
+        reply = {"celsius": self.celsius}
+        if not self.legacy:
+            try:
+                reply["seq"] = json.loads(data.decode())["seq"]
+            except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+                pass
+        payload = json.dumps(reply).encode()
+        if self.delay:
+            asyncio.get_running_loop().call_later(
+                self.delay, self.transport.sendto, payload, addr
+            )
+        else:
+            self.transport.sendto(payload, addr)
+
+
+async def serve(host, port, **kwargs):
+    """Starts a fake thermometer, returns its transport and protocol."""
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(
+        lambda: FakeThermometerProtocol(**kwargs),
+        local_addr=(host, port)
+    )
+
+
+async def benchmark(host, port, requests, timeout, retries, backoff):
+    """
+    Sends requests to thermometer at host:port one after the other.
+    Returns latencies of successful requests (seconds)
+    and the number of timeouts.
+    """
+    thermometer = ThermometerLocal(host, port, timeout, retries, backoff)
+    latencies = []
+    timeouts = 0
+    for _ in range(requests):
+        start = time.perf_counter()
+        try:
+            await thermometer.request_temperatures()
+            latencies.append(time.perf_counter() - start)
+        except ThermometerLocalTimeout:
+            timeouts += 1
+    thermometer.close()
+    return latencies, timeouts
+
+
+async def _main(args):
+    transport, protocol = await serve(
+        args.host,
+        args.port,
+        celsius=args.celsius,
+        delay=args.delay,
+        drop=args.drop,
+        legacy=args.legacy
+    )
+    print('Fake thermometer listening at {}:{}'.format(args.host, args.port))
+    try:
+        if not args.benchmark:
+            await asyncio.Event().wait()
+        latencies, timeouts = await benchmark(
+            args.host,
+            args.port,
+            args.benchmark,
+            args.timeout,
+            args.retries,
+            args.backoff
+        )
+    finally:
+        transport.close()
+    if latencies:
+        latencies.sort()
+        print('requests: {}, timeouts: {}'.format(args.benchmark, timeouts))
+        print('mean: {:.3f} ms, median: {:.3f} ms, p99: {:.3f} ms'.format(
+            statistics.mean(latencies) * 1000,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000
+        ))
+    else:
+        print('All {} requests timed out.'.format(args.benchmark))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Emulates the ESP8266 UDP thermometer,'
+            ' optionally benchmarks ThermometerLocal against it.'
+        )
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4210)
+    parser.add_argument('--celsius', type=float, default=20.0)
+    parser.add_argument(
+        '--delay', type=float, default=0,
+        help='Seconds to wait before replying.'
+    )
+    parser.add_argument(
+        '--drop', type=float, default=0,
+        help='Probability of not replying to a request.'
+    )
+    parser.add_argument(
+        '--legacy', action='store_true',
+        help='Do not echo sequence numbers.'
+    )
+    parser.add_argument(
+        '-b', '--benchmark', type=int, default=0,
+        help='Number of requests to send, then exit.'
+    )
+    parser.add_argument('--timeout', type=float, default=0.5)
+    parser.add_argument('--retries', type=int, default=0)
+    parser.add_argument('--backoff', type=float, default=0)
+    args = parser.parse_args()
+    asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    main()
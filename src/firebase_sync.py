@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import threading
+
+from persistence import atomic_write
+
+
+logger_name = 'thermostat.firebase'
+logger = logging.getLogger(logger_name)
+
+
+class SyncWorker():
+    '''
+    Sends updates to Firebase RTDB from a background thread,
+    so that the control loop never waits on the network.
+
+    Updates are queued by destination and coalesced by key: only the
+    latest value of each key is sent. Keys can be paths
+    ('0/monday/7') for multi-path updates, see _coalesce.
+    At most max_rate batches are sent per second; on errors the worker
+    backs off exponentially up to max_backoff seconds. Updates not
+    sent yet are saved to an outbox file and sent at next start.
+    '''
+
+    def __init__(
+        self,
+        db,
+        outbox_path,
+        max_rate=1,
+        max_backoff=300,
+        max_pending=1000,
+        on_error=None
+    ):
+        self.db = db
+        self.outbox_path = outbox_path
+        self.max_rate = max_rate
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self.on_error = on_error
+        # destination: {key: value}, oldest destination first
+        self.pending = self._load_outbox()
+        self.sent = 0
+        self.errors = 0
+        self._outbox_dirty = bool(self.pending)
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name='firebase-sync', daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, destination, payload):
+        '''
+        Queues payload for destination, replacing values
+        of the same keys still waiting to be sent.
+        '''
+        with self._condition:
+            pending = self.pending.setdefault(destination, {})
+            for key, value in payload.items():
+                _coalesce(pending, key, value)
+            while self.queue_depth() > self.max_pending:
+                dropped = next(iter(self.pending))
+                logger.warning(
+                    'Sync queue full, dropping updates to {}.'.format(dropped)
+                )
+                del self.pending[dropped]
+            self._condition.notify()
+
+    def queue_depth(self):
+        # list() so that it can be read from other threads, see metrics
+        return sum(len(payload) for payload in list(self.pending.values()))
+
+    def stop(self, timeout=5):
+        '''
+        Sends what's pending if possible, saves the rest to the outbox.
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        with self._condition:
+            if self.pending or self._outbox_dirty:
+                self._save_outbox()
+
+    def _run(self):
+        backoff = 0
+        while True:
+            with self._condition:
+                while not self.pending and not self._stopping:
+                    self._condition.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, {}
+            if self._send(batch):
+                backoff = 0
+                wait = 1 / self.max_rate
+                with self._condition:
+                    if self._outbox_dirty and not self.pending:
+                        self._save_outbox()
+            else:
+                with self._condition:
+                    # newer values queued meanwhile win over failed ones,
+                    # coalesced so that paths never overlap
+                    for destination, payload in self.pending.items():
+                        merged = batch.setdefault(destination, {})
+                        for key, value in payload.items():
+                            _coalesce(merged, key, value)
+                    self.pending = batch
+                    self._save_outbox()
+                if self._stopping:
+                    return
+                backoff = min(max(backoff * 2, 1), self.max_backoff)
+                wait = backoff
+            with self._condition:
+                if not self._stopping:
+                    self._condition.wait_for(lambda: self._stopping, wait)
+
+    def _send(self, batch):
+        '''
+        Sends every destination on its own, so that one failing
+        doesn't hold back the others. Sent ones are removed from
+        batch. Returns True if all were sent.
+        '''
+        for destination in list(batch):
+            try:
+                self.db.child(destination).update(batch[destination])
+            except Exception as e:
+                self.errors += 1
+                logger.warning(
+                    'Could not sync {} to Firebase: {}'.format(destination, e)
+                )
+                if self.on_error is not None:
+                    self.on_error(e)
+                continue
+            self.sent += 1
+            del batch[destination]
+        return not batch
+
+    def _load_outbox(self):
+        if not os.path.isfile(self.outbox_path):
+            return {}
+        try:
+            with open(self.outbox_path) as f:
+                outbox = json.load(f)
+        except ValueError:
+            logger.warning('Ignoring corrupt {}.'.format(self.outbox_path))
+            return {}
+        if outbox:
+            logger.info('Loaded {} pending updates from outbox.'.format(
+                len(outbox)
+            ))
+        return outbox
+
+    def _save_outbox(self):
+        atomic_write(self.outbox_path, json.dumps(self.pending), fsync=False)
+        # empty outbox must be written again once sent
+        self._outbox_dirty = bool(self.pending)
+
+
+def _coalesce(pending, key, value):
+    '''
+    Queues value at path key. A multi-path update can't contain both
+    a path and one of its descendants: values queued below key are
+    replaced, a value queued above key gets value written inside it.
+    '''
+    for queued in list(pending):
+        if queued.startswith(key + '/'):
+            del pending[queued]
+        elif key.startswith(queued + '/'):
+            # a value that is not a dict is replaced, like Firebase does
+            node = pending[queued] = (
+                dict(pending[queued]) if isinstance(pending[queued], dict)
+                else {}
+            )
+            *parents, leaf = key[len(queued) + 1:].split('/')
+            for parent in parents:
+                child = node.get(parent)
+                node[parent] = dict(child) if isinstance(child, dict) else {}
+                node = node[parent]
+            node[leaf] = value
+            return
+    pending[key] = value
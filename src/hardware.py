@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import logging
+import math
+import random
+import time
+
+
+logger_name = 'thermostat.hardware'
+logger = logging.getLogger(logger_name)
+
+
+class RPiGPIO():
+    '''
+    GPIO backend for the Raspberry Pi.
+    RPi.GPIO is imported only when this backend is used.
+    '''
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.LOW = GPIO.LOW
+        self.HIGH = GPIO.HIGH
+
+    def setup(self, channel, direction, initial):
+        self.GPIO.setmode(self.GPIO.BOARD)
+        self.GPIO.setup(channel=channel, direction=direction, initial=initial)
+
+    def output(self, channel, value):
+        self.GPIO.output(channel, value)
+
+    def cleanup(self, channel):
+        self.GPIO.cleanup(channel)
+
+
+class SimulatedGPIO():
+    '''
+    GPIO backend keeping channel states in memory.
+    When a room is given, the relay (active low, like the real board)
+    switches the room's heater.
+    '''
+
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, room=None):
+        self.room = room
+        self.channels = {}
+
+    def setup(self, channel, direction, initial):
+        self.channels[channel] = initial
+        self._update_room(channel)
+
+    def output(self, channel, value):
+        self.channels[channel] = value
+        self._update_room(channel)
+
+    def cleanup(self, channel):
+        self.channels[channel] = self.HIGH
+        self._update_room(channel)
+
+    def _update_room(self, channel):
+        if self.room is not None:
+            self.room.set_heater(self.channels[channel] == self.LOW)
+
+
+class RoomModel():
+    '''
+    First order thermal model of a room:
+        dT/dt = heating_rate * heater - loss_rate * (T - outside)
+    heating_rate in degrees per second, loss_rate in 1/s.
+    Solved exactly between heater switches, so any step size is fine.
+
+    Time comes from clock (seconds), multiplied by acceleration
+    to run simulated time faster than real time.
+    '''
+
+    def __init__(
+        self,
+        temperature=18.0,
+        outside=5.0,
+        heating_rate=0.002,
+        loss_rate=0.0001,
+        acceleration=1,
+        clock=time.monotonic
+    ):
+        self.temperature = temperature
+        self.outside = outside
+        self.heating_rate = heating_rate
+        self.loss_rate = loss_rate
+        self.acceleration = acceleration
+        self.clock = clock
+        self.heater = False
+        self.updated = clock()
+
+    def equilibrium(self, heater):
+        return self.outside + heater * self.heating_rate / self.loss_rate
+
+    def advance(self, seconds):
+        '''
+        Moves the model forward by seconds of simulated time.
+        '''
+        target = self.equilibrium(self.heater)
+        self.temperature = target + (self.temperature - target) * math.exp(
+            -self.loss_rate * seconds
+        )
+
+    def read(self):
+        '''
+        Room temperature now.
+        '''
+        now = self.clock()
+        self.advance((now - self.updated) * self.acceleration)
+        self.updated = now
+        return self.temperature
+
+    def set_heater(self, heater):
+        self.read()
+        self.heater = heater
+
+
+class SimulatedThermometer():
+    '''
+    Thermometer reading a RoomModel, with optional gaussian noise.
+    '''
+
+    def __init__(self, room, noise=0):
+        self.room = room
+        self.noise = noise
+
+    async def request_temperatures(self):
+        return round(self.room.read() + random.gauss(0, self.noise), 2)
+
+    def close(self):
+        pass
+
+
+def get_gpio(backend, room=None):
+    if backend == 'rpi':
+        return RPiGPIO()
+    elif backend == 'simulated':
+        return SimulatedGPIO(room)
+    raise ValueError('Unknown hardware backend: {}'.format(backend))
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+import collections
+import logging
+import math
+import time
+
+import metrics
+
+
+logger_name = 'thermostat.instrumentation'
+logger = logging.getLogger(logger_name)
+
+# values below 2 ** (_sub_bucket_bits + 1) are counted exactly,
+# larger ones with 2 ** _sub_bucket_bits buckets per power of two
+# (about 3% relative error), like an HDR histogram
+_sub_bucket_bits = 5
+_sub_buckets = 1 << _sub_bucket_bits
+
+# seconds, upper bounds of the buckets exported to /metrics
+metrics_buckets = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5,
+)
+
+
+class Histogram():
+    '''
+    Log-linear histogram of non negative integers (microseconds here).
+    Recording is a few integer operations and memory stays small
+    (under 1000 buckets for a whole hour), whatever the number of
+    samples, so it can stay on in production.
+    '''
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = _bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        '''
+        Highest value equivalent to the given percentile
+        (upper bound of its bucket, never above max).
+        '''
+        if not self.count:
+            return None
+        rank = max(math.ceil(percentile / 100 * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_top(index), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        '''
+        Count of values in each of the given buckets (sorted upper
+        bounds) and above the last one. Values are placed by the
+        top of their bucket, so they are never counted too low.
+        '''
+        counts = [0] * (len(bounds) + 1)
+        position = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            top = _bucket_top(index)
+            while position < len(bounds) and bounds[position] < top:
+                position += 1
+            counts[position] += count
+        return counts
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+def _bucket_index(value):
+    if value < 2 * _sub_buckets:
+        return value
+    shift = value.bit_length() - _sub_bucket_bits - 1
+    return shift * _sub_buckets + (value >> shift)
+
+
+def _bucket_top(index):
+    if index < 2 * _sub_buckets:
+        return index
+    shift = index // _sub_buckets - 1
+    return ((index - shift * _sub_buckets + 1) << shift) - 1
+
+
+class _Phase():
+
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record_ns(
+            self.name, time.perf_counter_ns() - self.start
+        )
+
+
+class Instrumentation():
+    '''
+    Timings of the phases of the thermostat's tasks, in microseconds,
+    measured with the monotonic perf_counter:
+
+        with instrumentation.phase('relay'):
+            ...
+
+    Histograms are kept since start and since the last log_summary,
+    so that the periodic summary shows recent behaviour while
+    summary() still has the whole picture.
+
+    started is the time.monotonic() milestones are measured from,
+    e.g. when the process started loading modules.
+    '''
+
+    def __init__(self, started=None):
+        self.histograms = collections.defaultdict(Histogram)
+        self.window = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        # name: seconds since started, in the order they were reached
+        self.milestones = {}
+        self.started = time.monotonic() if started is None else started
+        self.window_started = time.monotonic()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, seconds):
+        self.record_ns(name, seconds * 1e9)
+
+    def record_ns(self, name, nanoseconds):
+        microseconds = nanoseconds // 1000
+        self.histograms[name].record(microseconds)
+        self.window[name].record(microseconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def mark(self, name):
+        '''
+        Records when a milestone (e.g. a startup stage) was reached.
+        '''
+        self.milestones[name] = time.monotonic() - self.started
+
+    def summary(self, window=False):
+        histograms = self.window if window else self.histograms
+        started = self.window_started if window else self.started
+        return {
+            'seconds': time.monotonic() - started,
+            'phases_us': {
+                name: histogram.summary()
+                for name, histogram in sorted(histograms.items())
+            },
+            'counters': dict(self.counters),
+            'milestones_s': dict(self.milestones),
+        }
+
+    def metrics(self):
+        '''
+        Lines in the Prometheus text format for the metrics registry,
+        timings since start in seconds.
+        '''
+        bounds = [bound * 1e6 for bound in metrics_buckets]
+        samples = []
+        for name, histogram in sorted(self.histograms.items()):
+            counts = histogram.cumulative(bounds)
+            samples.extend(metrics.histogram_samples(
+                {'name': name},
+                zip(metrics_buckets, counts),
+                counts[-1],
+                histogram.total / 1e6
+            ))
+        lines = metrics.render_family(
+            'thermostat_timing_seconds',
+            'Duration of loop tasks and phases, delay of timed wakeups.',
+            'histogram',
+            samples
+        )
+        lines.extend(metrics.render_family(
+            'thermostat_loop_events_total',
+            'Task overruns, triggered runs and relay toggles.',
+            'counter',
+            [
+                ('', {'name': name}, count)
+                for name, count in sorted(self.counters.items())
+            ]
+        ))
+        lines.extend(metrics.render_family(
+            'thermostat_startup_seconds',
+            'When each startup stage was reached, since start.',
+            'gauge',
+            [
+                ('', {'stage': name}, seconds)
+                for name, seconds in list(self.milestones.items())
+            ]
+        ))
+        return lines
+
+    def log_summary(self):
+        '''
+        Logs timings since the previous call, one line per phase.
+        '''
+        summary = self.summary(window=True)
+        logger.info(
+            'Timings over the last %.1f s (us), counters: %s',
+            summary['seconds'], summary['counters']
+        )
+        for name, phase in summary['phases_us'].items():
+            logger.info(
+                '%-20s n=%-7d p50=%-8s p99=%-8s max=%s',
+                name, phase['count'], phase['p50'], phase['p99'], phase['max']
+            )
+        self.window = collections.defaultdict(Histogram)
+        self.window_started = time.monotonic()
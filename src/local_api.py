@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+import asyncio
+import json
+import logging
+import re
+import urllib.parse
+
+import metrics
+
+
+logger_name = 'thermostat.api'
+logger = logging.getLogger(logger_name)
+
+reasons = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+}
+
+requests = metrics.registry.counter(
+    'thermostat_api_requests_total',
+    'Requests to the local API, by method and status.',
+    ('method', 'status')
+)
+
+
+class Request():
+
+    def __init__(self, method, path, query, version, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        # names lower case
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Response():
+
+    def __init__(self, body=b'', status=200, content_type='text/plain'):
+        if isinstance(body, str):
+            body = body.encode()
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data), status, 'application/json')
+
+
+class LocalAPI():
+    '''
+    HTTP/1.1 server for the local APIs, running in the thermostat's
+    event loop instead of a thread of its own.
+
+    Connections are kept alive and served concurrently, each
+    in its own task. Handlers run in the loop thread too, so they
+    must be quick: they read state or post commands, never wait
+    for the control loop (see Thermostat.post_command).
+    '''
+
+    def __init__(
+        self,
+        host='0.0.0.0',
+        port=5000,
+        allow_origin=None,
+        keepalive_timeout=15,
+        max_body=65536
+    ):
+        self.host = host
+        self.port = port
+        self.allow_origin = allow_origin
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body = max_body
+        # (method, compiled path pattern, handler)
+        self.routes = []
+        self.server = None
+
+    def route(self, method, pattern, handler):
+        '''
+        Calls handler(request, **params) for requests matching
+        method and pattern, e.g. '/device/{device_id}/command'.
+        handler returns a Response.
+        '''
+        regex = re.sub(
+            r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', re.escape(pattern)
+        )
+        self.routes.append((method, re.compile(regex + '$'), handler))
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._serve, self.host, self.port
+        )
+        logger.info('Local API listening on %s:%s.', self.host, self.port)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(reader), self.keepalive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    # malformed request, the connection can't be reused
+                    response, keep_alive = request, False
+                else:
+                    response = await self._handle(request)
+                    keep_alive = _keep_alive(request)
+                requests.inc(
+                    method=getattr(request, 'method', ''),
+                    status=response.status
+                )
+                writer.write(self._format(response, keep_alive))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        '''
+        Returns a Request, a Response for malformed requests,
+        None if the client closed the connection.
+        '''
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if not e.partial.strip():
+                return None
+            raise
+        except asyncio.LimitOverrunError:
+            return Response(status=431)
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            return Response(status=400)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            return Response(status=501)
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return Response(status=400)
+        if length > self.max_body:
+            return Response(status=413)
+        body = await reader.readexactly(length) if length else b''
+        url = urllib.parse.urlsplit(target)
+        return Request(
+            method,
+            urllib.parse.unquote(url.path),
+            urllib.parse.parse_qs(url.query),
+            version,
+            headers,
+            body
+        )
+
+    async def _handle(self, request):
+        allowed = False
+        for method, regex, handler in self.routes:
+            match = regex.match(request.path)
+            if match is None:
+                continue
+            if method != request.method:
+                allowed = True
+                continue
+            try:
+                response = handler(request, **match.groupdict())
+                if asyncio.iscoroutine(response):
+                    response = await response
+                return response
+            except Exception:
+                logger.exception('Error handling {} {}.'.format(
+                    request.method, request.path
+                ))
+                return Response(status=500)
+        return Response(status=405 if allowed else 404)
+
+    def _format(self, response, keep_alive):
+        headers = [
+            'HTTP/1.1 {} {}'.format(
+                response.status, reasons.get(response.status, '')
+            ),
+            'Content-Type: {}'.format(response.content_type),
+            'Content-Length: {}'.format(len(response.body)),
+            'Connection: {}'.format('keep-alive' if keep_alive else 'close'),
+        ]
+        if self.allow_origin:
+            headers.append(
+                'Access-Control-Allow-Origin: {}'.format(self.allow_origin)
+            )
+        return '\r\n'.join(headers).encode() + b'\r\n\r\n' + response.body
+
+
+def _keep_alive(request):
+    connection = request.headers.get('connection', '').lower()
+    if request.version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
@@ -1,28 +1,88 @@
 #!/usr/bin/python3
 
+import argparse
+import bisect
 import json
+import logging
 import os
 
+from persistence import atomic_write
+
+
+logger_name = 'thermostat.log'
+logger = logging.getLogger(logger_name)
+
+
 class LogHandler():
+    '''
+    Daily log in JSON Lines format: one entry per line,
+    appended without reading the rest of the file.
+    An index file ('<log>.idx') keeps the offset of the first entry
+    of each date, for lookups by date without scanning the log.
+
+    A log in the old format (a JSON array in 'log.json')
+    is migrated once to 'log.jsonl'.
+    '''
 
     def __init__(self, log_path):
-        self.log_path = log_path
+        root, ext = os.path.splitext(log_path)
+        if ext == '.json':
+            self.legacy_path = log_path
+            self.log_path = '{}.jsonl'.format(root)
+        else:
+            self.legacy_path = None
+            self.log_path = log_path
+        self.index_path = '{}.idx'.format(self.log_path)
+        # sorted dates and offsets of their first entry, loaded lazily
+        self._dates = None
+        self._offsets = None
+        self.migrate()
 
-    def write_log(self, data):
+    def migrate(self):
+        '''
+        Converts the JSON array log to JSON Lines, if not done yet.
+        The old file is kept as '<log>.json.migrated'.
+        '''
         if (
-            not os.path.isfile(self.log_path) or
-            not os.stat(self.log_path).st_size
+            self.legacy_path is None
+            or not os.path.isfile(self.legacy_path)
+            or os.path.isfile(self.log_path)
         ):
-            with open(self.log_path, "w") as f:
-                f.write(json.dumps([data], indent=2))
-                f.write("\n")
+            return
+        if os.stat(self.legacy_path).st_size:
+            with open(self.legacy_path) as f:
+                entries = json.load(f)
         else:
-            with open(self.log_path) as f:
-                log_file = json.load(f)
-            log_file.append(data)
-            with open(self.log_path, "w") as f:
-                f.write(json.dumps(log_file, indent=2))
-                f.write("\n")
+            entries = []
+        atomic_write(self.log_path, ''.join(
+            '{}\n'.format(json.dumps(entry)) for entry in entries
+        ))
+        if os.path.isfile(self.index_path):
+            # stale, rebuilt at first lookup
+            os.remove(self.index_path)
+        os.rename(self.legacy_path, '{}.migrated'.format(self.legacy_path))
+        logger.info('Migrated {} entries from {} to {}.'.format(
+            len(entries), self.legacy_path, self.log_path
+        ))
+
+    def write_log(self, data):
+        line = '{}\n'.format(json.dumps(data)).encode()
+        with open(self.log_path, 'a+b') as f:
+            offset = f.seek(0, os.SEEK_END)
+            if offset:
+                # don't glue to a line torn by a crash
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+                    offset += 1
+            f.write(line)
+        date = data.get('date')
+        dates = self._index_dates()
+        if date is not None and (not dates or date > dates[-1]):
+            with open(self.index_path, 'a') as f:
+                f.write('{} {}\n'.format(date, offset))
+            self._dates.append(date)
+            self._offsets.append(offset)
         return "Wrote log to file."
 
     def save_daily_entry(self, time_elapsed, last):
@@ -31,3 +91,96 @@ class LogHandler():
             "time_elapsed": time_elapsed
         }
         self.write_log(data)
+
+    def read_log(self, start=None, end=None):
+        '''
+        Streams entries with start <= date <= end (ISO format strings),
+        one at a time, without loading the whole log.
+        '''
+        if not os.path.isfile(self.log_path):
+            return
+        offset = 0
+        if start is not None:
+            dates = self._index_dates()
+            i = bisect.bisect_left(dates, start)
+            if i == len(dates):
+                return
+            offset = self._offsets[i]
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn line
+                    continue
+                date = entry.get('date')
+                if date is not None:
+                    if end is not None and date > end:
+                        break
+                    if start is not None and date < start:
+                        continue
+                yield entry
+
+    def find(self, date):
+        '''
+        Returns all entries of given date.
+        '''
+        return list(self.read_log(date, date))
+
+    def _index_dates(self):
+        if self._dates is None:
+            self._load_index()
+        return self._dates
+
+    def _load_index(self):
+        self._dates = []
+        self._offsets = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        date, offset = line.split()
+                        offset = int(offset)
+                    except ValueError:
+                        continue
+                    self._dates.append(date)
+                    self._offsets.append(offset)
+        elif os.path.isfile(self.log_path):
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        logger.info('Rebuilding index of {}.'.format(self.log_path))
+        offset = 0
+        with open(self.log_path, 'rb') as f:
+            for line in f:
+                try:
+                    date = json.loads(line).get('date')
+                except ValueError:
+                    date = None
+                if date is not None and (
+                    not self._dates or date > self._dates[-1]
+                ):
+                    self._dates.append(date)
+                    self._offsets.append(offset)
+                offset += len(line)
+        with open(self.index_path, 'w') as f:
+            for date, offset in zip(self._dates, self._offsets):
+                f.write('{} {}\n'.format(date, offset))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print daily log entries, one JSON per line.'
+    )
+    parser.add_argument('log_path')
+    parser.add_argument('-f', '--from', dest='start', help='YYYY-MM-DD')
+    parser.add_argument('-t', '--to', dest='end', help='YYYY-MM-DD')
+    args = parser.parse_args()
+    for entry in LogHandler(args.log_path).read_log(args.start, args.end):
+        print(json.dumps(entry))
+
+
+if __name__ == '__main__':
+
+    main()
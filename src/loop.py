@@ -1,9 +1,125 @@
 #!/usr/bin/python3
 
+import asyncio
+import logging
+import math
+
+
+logger_name = 'thermostat.loop'
+logger = logging.getLogger(logger_name)
+
+
 class Loop():
+    '''
+    Runs coroutine functions periodically inside one event loop,
+    each one on its own cadence.
+
+    Deadlines are absolute loop.time() targets, so the time spent
+    inside a task doesn't make its schedule drift.
+    A task that overruns skips the periods it missed.
+    A task can also be triggered to run right away (see trigger),
+    its period then starts again from that run.
+
+    With an Instrumentation, the duration of each run is recorded
+    under the task's name, how late each timed wakeup was under
+    'jitter' and overruns in counters.
+    '''
+
+    def __init__(self, exit, instrumentation=None):
+        # threading.Event, set from signal handlers to stop the loop
+        self.exit = exit
+        self.instrumentation = instrumentation
+        self.tasks = []
+        self._stopping = False
+        # name: asyncio.Event waking the task up before its deadline
+        self._wakeups = {}
+
+    def every(self, interval, func, name=None, now=True):
+        '''
+        Schedules func (a coroutine function without arguments)
+        every interval seconds. interval can be a callable returning
+        the interval, to follow changes in settings.
+        With now False the first run is after one interval.
+        '''
+        self.tasks.append((interval, func, name or func.__name__, now))
+
+    def trigger(self, name):
+        '''
+        Runs task name as soon as possible. Triggers arriving
+        while the task runs make it run once more afterwards.
+        To be called from the loop thread.
+        '''
+        wakeup = self._wakeups.get(name)
+        if wakeup is not None:
+            wakeup.set()
+
+    async def run(self):
+        '''
+        Runs all scheduled tasks until exit is set,
+        then lets running tasks complete and returns.
+        '''
+        loop = asyncio.get_running_loop()
+        self._stopping = False
+        self._wakeups = {
+            name: asyncio.Event() for _, _, name, _ in self.tasks
+        }
+        loop.run_in_executor(None, self._wait_exit, loop)
+        await asyncio.gather(*[
+            self._run_periodic(interval, func, name, now)
+            for interval, func, name, now in self.tasks
+        ])
 
-    def __init__(self):
+    def _wait_exit(self, loop):
+        self.exit.wait()
+        loop.call_soon_threadsafe(self._stop)
 
-        pass
+    def _stop(self):
+        self._stopping = True
+        for wakeup in self._wakeups.values():
+            wakeup.set()
 
-    def 
+    async def _run_periodic(self, interval, func, name, now):
+        loop = asyncio.get_running_loop()
+        wakeup = self._wakeups[name]
+        if not now:
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(),
+                    interval() if callable(interval) else interval
+                )
+            except asyncio.TimeoutError:
+                pass
+        deadline = loop.time()
+        instrumentation = self.instrumentation
+        while not self._stopping:
+            wakeup.clear()
+            started = loop.time()
+            try:
+                await func()
+            except Exception:
+                logger.exception('Error in {} task.'.format(name))
+            period = interval() if callable(interval) else interval
+            deadline += period
+            now = loop.time()
+            if instrumentation is not None:
+                instrumentation.record(name, now - started)
+            if deadline < now:
+                missed = math.ceil((now - deadline) / period)
+                logger.warning(
+                    '{} task overran, skipping {} period(s).'.format(
+                        name, missed
+                    )
+                )
+                if instrumentation is not None:
+                    instrumentation.count('overruns.' + name)
+                deadline += missed * period
+            try:
+                await asyncio.wait_for(wakeup.wait(), deadline - now)
+            except asyncio.TimeoutError:
+                if instrumentation is not None:
+                    instrumentation.record('jitter', loop.time() - deadline)
+            else:
+                # triggered: the next period starts from this run
+                deadline = loop.time()
+                if instrumentation is not None:
+                    instrumentation.count('triggered.' + name)
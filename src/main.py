@@ -3,24 +3,36 @@
 import argparse
 import asyncio
 import datetime
+import functools
 import json
 import logging
+import math
 import os
+import queue
 import signal
 # import socket
 import threading
 import time
 
-import flask
-from iottly_sdk import IottlySDK
+# reference for startup timings, see Instrumentation.mark
+started = time.monotonic()
 
+from control import engine_from_settings, target_temperature
+import events
+from events import EventBus
 from exceptions import *
+import hardware
+from instrumentation import Instrumentation
 from log_handler import LogHandler
+from loop import Loop
+import metrics
 from program import Program
 from relay import Relay
-from settings_handler import SettingsHandler
-from thermometer import ThermometerLocal, ThermometerDirect
-from thermostat_pyrebase import PyrebaseInstance
+from sensors import SensorRegistry
+from settings_handler import SettingsHandler, SettingsState
+import snapshot
+from thermal import Preheat, ThermalModel
+from timeseries import TimeSeriesStore
 import util
 
 
@@ -45,6 +57,12 @@ def _retrieve_iottly_info(iottly_path):
     device_id = iottly_settings["IOTTLY_MQTT_DEVICE_USER"]
     return project_id, device_id
 
+iottly_messages = metrics.registry.counter(
+    'thermostat_iottly_messages_total',
+    'Messages from and to iottly, by direction and type.',
+    ('direction', 'type')
+)
+
 # iottlySDK functions
 
 
@@ -58,13 +76,15 @@ def on_connection_status_changed(status):
 
 # module inits
 
-class WSDK(IottlySDK):
-    def _process_msg_from_agent(self, msg):
-        logger.info("MSG FROM AGENT: {}".format(msg))
-        super()._process_msg_from_agent(msg)
+def _init_iottly_sdk():
+    # imported only now, it takes seconds on a Pi Zero
+    from iottly_sdk import IottlySDK
 
+    class WSDK(IottlySDK):
+        def _process_msg_from_agent(self, msg):
+            logger.info("MSG FROM AGENT: {}".format(msg))
+            super()._process_msg_from_agent(msg)
 
-def _init_iottly_sdk():
     iottly_sdk = WSDK(
         name='thermostat-py',
         max_buffered_msgs=100,
@@ -87,19 +107,43 @@ def _init_program(program, paths):
     )
 
 
-def _init_relay(settings, settings_path):
-    return Relay(settings, settings_path)
+def _init_relay(settings, settings_path, gpio):
+    return Relay(settings, settings_path, gpio)
 
 
-def _init_thermometer(settings, intervals):
-    if settings['direct']:
-        return ThermometerDirect()
-    else:
-        return ThermometerLocal(
-            settings["UDP_IP"],
-            settings["UDP_port"],
-            intervals["temperature"]
-        )
+def _init_timeseries(path, retention):
+    return TimeSeriesStore(path, retention)
+
+
+def _init_thermal_model(preheat_configs):
+    return ThermalModel(
+        preheat_configs["interval"], preheat_configs["forgetting"]
+    )
+
+
+def _init_sensors(settings, intervals, room):
+    return SensorRegistry.from_settings(settings, intervals, room)
+
+
+def _program_changes(edit):
+    """
+    Changes for Program.edit_slots from a program command.
+    program_weekday (and program_hour) can be lists.
+    """
+    days = edit["program_weekday"]
+    if not isinstance(days, list):
+        days = [days]
+    if "program_start" in edit:
+        # sub-hour intervals, exception days as ISO dates
+        return [
+            (day, edit["program_start"], edit["program_end"], edit["value"])
+            for day in days
+        ]
+    hours = edit["program_hour"]
+    if not isinstance(hours, list):
+        hours = [hours]
+    return [(day, hour, edit["value"]) for day in days for hour in hours]
+
 
 # settings file interfacing
 
@@ -131,121 +175,56 @@ def _load_settings(settings_handler):
         "time_elapsed": time_elapsed
     }
 
-# action
-
-
-async def _handle_on_and_off(
-            current,
-            relay,
-            manual,
-            auto,
-            program_target_temperature,
-            desired_temp,
-            room_temperature
-        ):
-    """Handles all there is to turning the heater on or off.
-    NOTE: relay module writes relay state to settings_file
-    at every call of on() or off() methods.
-    No need to rewrite that in this module."""
-    logger.debug("called action func")
-    # MANUAL MODE
-    if manual:
-        logger.debug("manual of _handle_on_and_off")
-        return _manual_mode(desired_temp, room_temperature, relay)
-    # AUTO MODE
-    elif auto:
-        logger.debug("auto of _handle_on_and_off")
-        return _auto_mode(
-            current,
-            desired_temp,
-            program_target_temperature,
-            relay,
-            room_temperature
-        )
-    # BOTH MANUAL AND AUTO ARE OFF
-    else:
-        logger.debug("else of _handle_on_and_off")
-        return relay.off()
-
-
-def _manual_mode(desired_temperature, room_temperature, relay):
-    """
-    Action to take when MANUAL mode is True.
-    Manual mode prevails over auto mode and so does desired_temperature
-    over numeric values in program.json
-    """
-    # Room temperature is lower than desired temperature
-    if room_temperature < desired_temperature:
-        if not relay.stats:
-            return relay.on()
-        else:
-            return relay.stats
-    # Room temperature satisfies desired temperature
-    else:
-        return relay.off()
-
-
-def _auto_mode(
-    current,
-    desired_temp,
-    program_target_temperature,
-    relay,
-    room_temperature
-):
-    ### TURN ON CASE
-    if (  # Value in program is bool
-        (
-            program_target_temperature is True
-            and room_temperature < desired_temp
-        )
-
-        # value in program is float
-        or (
-            util.is_number(program_target_temperature)
-            and room_temperature < program_target_temperature
-        )
-    ):
-        if not relay.stats:
-            return relay.on()
-        else:
-            return relay.stats
-    ### TURN OFF CASE
-    else:
-        return relay.off()
+# main
 
+# changes of these lift the minimum on and off times
+mode_keys = ("manual", "auto", "program", "desired_temp")
 
-# main
 
 class Thermostat():
-    def __init__(self, exit):
+    def __init__(self, exit, settings_path=None):
         self.exit = exit
-        args = _create_parser()
-        self.settings_handler = SettingsHandler(args.settings_path)
-        # inited empty then updated for later convenience
-        self.settings = {}
+        if settings_path is None:
+            settings_path = _create_parser().settings_path
+        self.settings_handler = SettingsHandler(settings_path)
+        # sensor readings, commands, schedule boundaries and file edits
+        # wake control up, see loop
+        self.bus = EventBus()
+        # (cmd_type, cmdpars) from iottly and local APIs, handled
+        # in the loop thread, see post_command
+        self.commands = queue.SimpleQueue()
+        self.command_handlers = {
+            "thermostat": self._thermostat_commands,
+            "program": self._program_handler,
+            "get_program": self._send_programs,
+        }
+        # per-phase timings, see _log_instrumentation
+        self.instrumentation = Instrumentation(started)
+        self.instrumentation.mark("imports")
+        metrics.registry.collect(self.instrumentation.metrics)
+        # changes go to subscribers once per control run, see _control
+        self.settings = SettingsState()
+        self.settings_version = None
         self._load_settings()
+        # changes from the settings file, not since the last control
+        self.settings.publish()
+        # writes (relay, sensors, commands) set only what they change
+        self.settings_handler.subscribe(self.settings.apply)
         self.program = _init_program(
             self.settings["program"], self.settings["paths"]
         )
-        iottly_path = self.settings["paths"]["iottly"]
-        self.project_id, self.device_id = _retrieve_iottly_info(iottly_path)
         self._init_logger()
         self._init_modules()
+        self.instrumentation.mark("modules")
+        # set by _init_cloud once connected, in the background,
+        # never for simulations and benchmarks
+        self.project_id = self.device_id = None
+        self.iottly_sdk = None
+        self.sync_worker = None
         self.time_since_start = 0
+        # settings changes from commands, applied by the next _control
         self.new_settings = {}
-        self.iottly_sdk.subscribe(
-            cmd_type="thermostat",
-            callback=self._thermostat_commands
-        )
-        self.iottly_sdk.subscribe(
-            cmd_type="program",
-            callback=self._program_handler
-        )
-        self.iottly_sdk.subscribe(
-            cmd_type="get_program",
-            callback=self._send_programs
-        )
-        self.send_to_app_keys = {
+        self.send_to_app_keys = (
             "auto",
             "desired_temp",
             "manual",
@@ -254,27 +233,26 @@ class Thermostat():
             "relay_state",
             "room_temperature",
             "time_elapsed"
-        }
+        )
+        # changes not sent to RTDB yet, all of them at the first sync
+        self.unsynced = {k: self.settings[k] for k in self.send_to_app_keys}
+        self.settings.subscribe(self.unsynced.update, self.send_to_app_keys)
+        # minimum on and off times don't apply to user changes
+        self.settings.subscribe(
+            lambda changes: self.engine.release(), mode_keys
+        )
+        self.settings.subscribe(
+            lambda changes: self._update_engine(),
+            ("control_configs", "intervals")
+        )
 
     def _load_settings(self):
-        settings = self.settings_handler.load_settings()
-        self.settings.update({
-            "log": settings["log"],
-            "mode": settings["mode"],
-            "manual": settings["mode"]["manual"],
-            "auto": settings["mode"]["auto"],
-            "program": settings["mode"]["program"],
-            "desired_temp": settings["mode"]["desired_temp"],
-            "paths": settings["paths"],
-            "intervals": settings["intervals"],
-            "relay_configs": settings["relay"],
-            "relay_state": settings["relay"]["state"],
-            "room_temperature": settings["temperatures"]["room"],
-            "thermometer_configs": settings["configs"],
-            "loglevel": settings["log"]["loglevel"],
-            "last_day_on": settings["log"]["last_day_on"],
-            "time_elapsed": settings["log"]["time_elapsed"],
-        })
+        """Takes in all settings again when the file was edited from
+        outside, changes written here come in through subscribe."""
+        version = self.settings_handler.refresh()
+        if version != self.settings_version:
+            self.settings.load(self.settings_handler.load_settings())
+            self.settings_version = version
 
     def _init_logger(self):
         logger_name = 'thermostat'
@@ -294,21 +272,134 @@ class Thermostat():
         self.custom_logger = _init_loghandler(
             self.settings["paths"]["daily_log"]
         )
+        backend = self.settings["thermometer_configs"]["backend"]
+        # thermal model of the room for the simulated backend
+        self.room = (
+            hardware.RoomModel() if backend == "simulated" else None
+        )
         self.relay = _init_relay(
             self.settings["relay_configs"],
-            self.settings_handler
+            self.settings_handler,
+            hardware.get_gpio(backend, self.room)
         )
-        self.thermometer = _init_thermometer(
+        self.timeseries = _init_timeseries(
+            self.settings["paths"]["timeseries"],
+            self.settings["retention"]
+        )
+        self.sensors = _init_sensors(
             self.settings["thermometer_configs"],
-            self.settings["intervals"]
+            self.settings["intervals"],
+            self.room
+        )
+        # learnt from history once control runs, see _start_services
+        self.thermal = _init_thermal_model(self.settings["preheat_configs"])
+        self.preheat = Preheat(
+            self.thermal, self.settings["preheat_configs"]["max_lead"]
         )
+        for name, help, attribute in (
+            (
+                'thermostat_room_heating_rate',
+                'Learnt warming with the heater on, degrees per second.',
+                'heating_rate'
+            ),
+            (
+                'thermostat_room_loss_rate',
+                'Learnt heat loss, fraction of the difference with'
+                ' outside per second.',
+                'loss_rate'
+            ),
+            (
+                'thermostat_room_outside_temperature',
+                'Learnt temperature the room tends to with the heater off.',
+                'outside'
+            ),
+        ):
+            metrics.registry.gauge(
+                name,
+                help,
+                func=lambda attribute=attribute: getattr(
+                    self.thermal, attribute
+                )
+            )
+
+    def _init_cloud(self):
+        """Connects to iottly and Firebase. Runs in a thread while
+        the loop is already controlling the heater, see loop."""
+        from firebase_sync import SyncWorker
+        from thermostat_pyrebase import PyrebaseInstance
+
+        iottly_path = self.settings["paths"]["iottly"]
+        self.project_id, self.device_id = _retrieve_iottly_info(iottly_path)
         self.iottly_sdk = _init_iottly_sdk()
+        self.instrumentation.mark("iottly")
         self.db = PyrebaseInstance(
             apiKey=os.environ["FIREBASE_API_KEY"],
             authDomain="thermostat-12d81.firebaseapp.com",
             databaseURL="https://thermostat-12d81.firebaseio.com",
             storageBucket="thermostat-12d81.appspot.com"
         ).db
+        sync_worker = SyncWorker(
+            self.db,
+            self.settings["paths"]["outbox"],
+            on_error=lambda e: self._report_error(str(e)),
+            **self.settings["firebase_configs"]
+        )
+        sync_worker.start()
+        # last, _sync starts sending as soon as it's set
+        self.sync_worker = sync_worker
+        self.instrumentation.mark("firebase")
+        metrics.registry.gauge(
+            'thermostat_firebase_queue_depth',
+            'Updates waiting to be sent to Firebase.',
+            func=self.sync_worker.queue_depth
+        )
+        metrics.registry.counter(
+            'thermostat_firebase_updates_total',
+            'Multi-path updates sent to Firebase.',
+            func=lambda: self.sync_worker.sent
+        )
+        metrics.registry.counter(
+            'thermostat_firebase_errors_total',
+            'Failed attempts to send to Firebase.',
+            func=lambda: self.sync_worker.errors
+        )
+        for cmd_type in self.command_handlers:
+            self.iottly_sdk.subscribe(
+                cmd_type=cmd_type,
+                callback=functools.partial(self._iottly_command, cmd_type)
+            )
+
+    def _iottly_command(self, cmd_type, cmdpars):
+        iottly_messages.inc(direction="in", type=cmd_type)
+        self.post_command(cmd_type, cmdpars)
+
+    def post_command(self, cmd_type, cmdpars):
+        """Queues a command for the loop thread, from any thread.
+        Handlers never touch the thermostat's state themselves."""
+        if cmd_type not in self.command_handlers:
+            raise ValueError("Unknown command type: {}".format(cmd_type))
+        self.commands.put((cmd_type, cmdpars))
+        self.bus.publish(events.COMMAND, command=cmd_type)
+
+    def _handle_commands(self):
+        while True:
+            try:
+                cmd_type, cmdpars = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.command_handlers[cmd_type](cmdpars)
+            except Exception:
+                logger.exception("Error handling {} command.".format(cmd_type))
+
+    def _report_error(self, error):
+        if self.iottly_sdk is not None:
+            self.iottly_sdk.send({"error": error})
+            iottly_messages.inc(direction="out", type="error")
+
+    def stats(self):
+        """What the app shows, as sent to Firebase."""
+        return {k: self.settings[k] for k in self.send_to_app_keys}
 
     def _thermostat_commands(self, cmdpars):
         logger.info("Thermostat command: {}".format(cmdpars))
@@ -327,273 +418,612 @@ class Thermostat():
     def _program_handler(self, cmdpars):
         logger.info("Program command: {}".format(cmdpars))
         program_number = cmdpars["program_number"]
-        program_weekday = cmdpars["program_weekday"]
-        program_hour = cmdpars["program_hour"]
-        value = cmdpars["value"]
+        # one change, or a batch of them, e.g. a drag across a day
+        changes = [
+            change
+            for edit in cmdpars.get("changes", [cmdpars])
+            for change in _program_changes(edit)
+        ]
         try:
-            self.program.edit_program(
-                program_number, program_weekday, program_hour, value
-            )
-            self._send_programs()
+            changed = self.program.edit_slots(program_number, changes)
         except Exception as e:
             logger.exception(e)
+            return
+        if changed:
+            # only the changed slots, as a multi-path update
+            self._send_to_firebase(
+                "programs/{}".format(self.device_id), changed
+            )
 
     def _send_programs(self, cmdpars={}):
         logger.info("Get Program command: {}".format(cmdpars))
         self._send_to_firebase(
             "programs/{}".format(self.device_id),
-            self.program.programs
+            # a copy, the sync worker sends it later from its thread
+            json.loads(json.dumps(self.program.programs))
         )
 
     def _send_to_firebase(self, destination, payload):
-        try:
-            (
-                self.db.child(destination)
-                    .update(payload)
-            )
-        except Exception as e:
-            self.iottly_sdk.send({"error": str(e)})
+        # never waits on the network, see SyncWorker
+        if self.sync_worker is not None:
+            self.sync_worker.submit(destination, payload)
 
-    def update_program_target_temperature(self, prev, current, reload):
-        if reload:
-            # load program
-            self.program = _init_program(
-                self.settings["program"], self.settings["paths"]
-            )
-        weekday = current["weekday"]
-        hour = current["hours"]
-        # load program setting at current day and time
-        program_now = self.program.program[weekday][str(hour)]
-        # return only if there's a difference
-        return program_now
+    def update_program_target_temperature(self):
+        """Program value now. Looked up again only after the next
+        transition of the program or after an edit; a timer wakes
+        control up at that transition."""
+        self.program.select(self.settings["program"])
+        program_key = (self.program.program_number, self.program.version)
+        now = util.clock.time()
+        if program_key == self.program_key and now < self.program_until:
+            if self.program_until != math.inf:
+                # no-op unless the timer fired before the wall clock
+                # got to the transition
+                self._arm_schedule_timer(self.program_until - now)
+            return self.program_now
+        when = util.clock.now()
+        self.program_key = program_key
+        transition = self.program.next_transition(when)
+        if transition is None:
+            self.program_until = math.inf
+        else:
+            self.program_until = transition.timestamp()
+            self._arm_schedule_timer(self.program_until - now, True)
+        return self.program.target_at(when)
 
-    async def loop(self):
-        stop = False
-        stop_time = self.settings["intervals"]["stop_time"]
-        program_now = None
-        time_after_sleep = 0
-        time_elapsed = 0
-        # start loop
-        logger.debug("Starting loop. Settings:\n{}".format(self.settings))
-        while not self.exit.is_set():
-            # initialize states
-            action = False
-            start = time.perf_counter()
-            # update current time and values from settings_file
-            current = util.get_now()
-            prev_program_target_temperature = program_now
-            program_now = self.update_program_target_temperature(
-                prev_program_target_temperature,
-                current,
-                True
+    async def _poll_sensor(self):
+        """Polls all thermometers and stores the aggregated temperature."""
+        logger.debug("Asking temperature to thermometers...")
+        with self.instrumentation.phase("sensor_await"):
+            errors = await self.sensors.poll()
+        for name, e in errors.items():
+            logger.warning(
+                "Could not retrieve temperatures from themometer {}: {!r}"
+                .format(name, e)
             )
-            last_settings = {
-                k: v for k, v in self.settings.items()
-            }
-            if "program_target_temperature" not in last_settings.keys():
-                # to compute differences at the first run
-                # when we don't have this key yet
-                last_settings.update(
-                    {"program_target_temperature": None}
+            self._report_error("{}: {!r}".format(name, e))
+        # last good values of sensors which failed this time are used
+        received_temperature = self.sensors.aggregate()
+        logger.info("Received temperature: %s", received_temperature)
+        if received_temperature is None:
+            if self.settings["room_temperature"] is not None:
+                # all readings are older than max_age: stale, not kept
+                logger.warning(
+                    "No temperature newer than %s s, holding the heater off.",
+                    self.sensors.max_age
                 )
-            # adds current target temperature from programs
-            #  because it's not an information I want to store
-            #  in the settings file
-            self.settings.update(
-                {"program_target_temperature": program_now}
+                self.settings_handler.handler({"temperatures": {"room": None}})
+                self.bus.publish(events.SENSOR, temperature=None)
+        elif received_temperature != self.settings["room_temperature"]:
+            self.settings_handler.handler(
+                {"temperatures": {"room": received_temperature}}
             )
-            # then computes differences to send only what has changed
+            self.bus.publish(events.SENSOR, temperature=received_temperature)
+
+    async def _control(self):
+        """Decides whether the heater should be on and keeps track
+        of the time it spent on."""
+        current = util.get_now()
+        now = util.clock.perf_counter()
+        # commands take effect in this same run
+        self._handle_commands()
+        new_settings, self.new_settings = self.new_settings, {}
+        if new_settings:
+            self.settings_handler.handler(new_settings)
+        with self.instrumentation.phase("settings_load"):
             self._load_settings()
-            diff_settings = util.compute_differences(
-                self.settings, last_settings
+        # adds current target temperature from programs
+        #  because it's not an information I want to store
+        #  in the settings file
+        # program.json edits are picked up by _watch_files
+        with self.instrumentation.phase("program_lookup"):
+            self.program_now = self.update_program_target_temperature()
+        self.settings.program_target_temperature = self.program_now
+        # engine and sync follow changes, see __init__
+        with self.instrumentation.phase("diff"):
+            self.settings.publish()
+        # log if day_changed
+        day_changed = util.check_same_day(
+            self.settings["last_day_on"],
+            current["formatted_date"]
+        )
+        if day_changed:
+            self.custom_logger.save_daily_entry(
+                self.settings["time_elapsed"],
+                self.settings["last_day_on"]
             )
-            # send stuff to RTDB
-            if any(diff_settings.values()):
-                payload = {
-                    k: v for k, v in self.settings.items()
-                    if k in diff_settings.keys() & self.send_to_app_keys
-                }
-                # send to firebase RTDB
-                # TODO: add try/except
+        # update elapsed time with heater on since previous decision
+        if self.last_action and self.last_control is not None:
+            self.time_since_start += now - self.last_control
+        self.last_control = now
+        target = target_temperature(
+            self.settings["manual"],
+            self.settings["auto"],
+            self.program_now,
+            self.settings["desired_temp"]
+        )
+        self.thermal.observe(
+            util.clock.time(),
+            self.settings["room_temperature"],
+            self.last_action
+        )
+        if self.settings["room_temperature"] is None:
+            # no reading from thermometer yet, or only stale ones
+            if self.relay.stats:
+                self.relay.off()
+                self.engine.switched(util.clock.time(), False)
+                self.instrumentation.count("relay_toggles")
+            self._cancel_control_timer()
+        else:
+            wake_at = None
+            if (
+                self.settings["auto"]
+                and not self.settings["manual"]
+                and self.settings["preheat_configs"]["enabled"]
+            ):
+                with self.instrumentation.phase("preheat"):
+                    target, wake_at = self._preheat_target(target)
+            with self.instrumentation.phase("relay"):
+                self._switch_relay(target, wake_at)
+        self.last_action = self.relay.stats
+        # the heater is under control, see _start_services
+        self.controlling.set()
+        # recorded at a fixed cadence, see _record_sample
+        self.target = target
+        # whole seconds go to time_elapsed, the rest is carried over
+        time_to_add = int(self.time_since_start)
+        self.time_since_start -= time_to_add
+        logger.debug("time_since_start: %s", self.time_since_start)
+        new_settings = {}
+        if day_changed:
+            new_settings["log"] = {
+                # a new day starts counting from zero
+                "time_elapsed": util.format_seconds(time_to_add),
+                "last_day_on": current["formatted_date"]
+            }
+        elif time_to_add:
+            time_elapsed = util.increment_time_elapsed(
+                self.settings, time_to_add
+            )
+            logger.info("time_elapsed: %s", time_elapsed)
+            new_settings["log"] = {"time_elapsed": time_elapsed}
+        if new_settings:
+            self.settings_handler.handler(new_settings)
+        # relay state and time_elapsed, to the app right away
+        self.settings.publish()
+
+    def _update_engine(self):
+        """Builds the control engine again when its settings change,
+        keeping the relay switch history."""
+        key = (
+            self.settings["control_configs"],
+            self.settings["intervals"]["stop_time"]
+        )
+        if key != self.engine_key:
+            self.engine = engine_from_settings(*key, self.engine)
+            self.engine_key = key
+            logger.debug("Control engine: %s", key)
+
+    def _preheat_target(self, target):
+        """Target raised ahead of the next program intervals,
+        see thermal.Preheat. Returns (target, wake_at)."""
+        self.preheat.max_lead = self.settings["preheat_configs"]["max_lead"]
+        return self.preheat.target(
+            util.clock.time(),
+            self.settings["room_temperature"],
+            target,
+            self._upcoming_targets()
+        )
+
+    def _upcoming_targets(self):
+        """(start, target) of the program intervals starting from
+        the next transition to max_lead seconds after it, so all
+        those pre-heating may start for before the transition.
+        Looked up again after it, like program_now."""
+        max_lead = self.preheat.max_lead
+        key = (
+            self.program_key,
+            self.program_until,
+            self.settings["desired_temp"],
+            max_lead
+        )
+        if key == self.upcoming_key:
+            return self.upcoming
+        self.upcoming_key = key
+        self.upcoming = []
+        if self.program_until != math.inf:
+            when = datetime.datetime.fromtimestamp(self.program_until)
+            for start, _, value in self.program.between(
+                when, when + datetime.timedelta(seconds=max_lead)
+            ):
+                self.upcoming.append((
+                    start.timestamp(),
+                    target_temperature(
+                        False, True, value, self.settings["desired_temp"]
+                    )
+                ))
+        return self.upcoming
+
+    def _switch_relay(self, target, preheat_at=None):
+        """Asks the engine what the relay should do and does it.
+        preheat_at is when pre-heating may have to start."""
+        now = util.clock.time()
+        on, wake_at = self.engine.decide(
+            now,
+            self.settings["room_temperature"],
+            target,
+            self.relay.stats
+        )
+        if preheat_at is not None:
+            wake_at = (
+                preheat_at if wake_at is None else min(wake_at, preheat_at)
+            )
+        if on != self.relay.stats:
+            if on:
+                self.relay.on()
+            else:
+                self.relay.off()
+            self.engine.switched(now, on)
+            self.instrumentation.count("relay_toggles")
+        logger.info("Relay state: %s", self.relay.stats)
+        self._cancel_control_timer()
+        if wake_at is not None:
+            # control runs again when the lockout ends, the
+            # strategy's cycle moves on or pre-heating has to start
+            # (locked_until wants strictly
+            # more than min_on or min_off)
+            self.control_timer = self.bus.publish_later(
+                max(wake_at - now, 0) + 0.1,
+                events.SCHEDULE,
+                reason="control"
+            )
+
+    def _cancel_control_timer(self):
+        if self.control_timer is not None:
+            self.control_timer.cancel()
+            self.control_timer = None
+
+    def _arm_schedule_timer(self, delay, replace=False):
+        """Wakes control up at the next program transition."""
+        if self.schedule_timer is not None:
+            if (
+                not replace
+                and self.schedule_timer.when()
+                > asyncio.get_running_loop().time()
+            ):
+                return
+            self.schedule_timer.cancel()
+        self.schedule_timer = self.bus.publish_later(
+            max(delay, 0), events.SCHEDULE, reason="program"
+        )
+
+    async def _watch_files(self):
+        """Publishes an event when settings or program are edited
+        from outside."""
+        if self.settings_handler.store.changed():
+            self.bus.publish(
+                events.FILE, path=self.settings_handler.settings_path
+            )
+        if self.program.reload_if_changed():
+            self.bus.publish(events.FILE, path=self.program.program_path)
+
+    async def _persist(self):
+        """One write for all changes since last call, relay's included."""
+        with self.instrumentation.phase("settings_flush"):
+            self.settings_handler.flush()
+
+    async def _record_sample(self):
+        """Samples on a fixed cadence, so that rollups are averages
+        over time whatever the pace of control runs."""
+        self.timeseries.record(
+            util.clock.time(),
+            self.settings["room_temperature"],
+            self.target,
+            self.relay.stats
+        )
+
+    async def _flush_timeseries(self):
+        self.timeseries.flush()
+
+    async def _sync(self):
+        """Sends to RTDB only what changed since last sync."""
+        if self.sync_worker is None:
+            # not connected yet: all changes go with the first sync
+            return
+        if self.unsynced:
+            payload = dict(self.unsynced)
+            self.unsynced.clear()
+            # send to firebase RTDB
+            with self.instrumentation.phase("firebase_send"):
                 self._send_to_firebase(
                     "data/{}".format(self.device_id),
                     payload
                 )
-                # self.iottly_sdk.call_agent('send_message', payload)
-            # log if day_changed
-            day_changed = util.check_same_day(
-                self.settings["last_day_on"],
-                current["formatted_date"]
+            # self.iottly_sdk.call_agent('send_message', payload)
+
+    async def _log_instrumentation(self):
+        self.instrumentation.log_summary()
+
+    async def _write_snapshot(self):
+        snapshot.write(
+            self.settings["paths"]["snapshot"], self._take_snapshot()
+        )
+
+    def _take_snapshot(self):
+        """Control state to resume from after a restart."""
+        time_since_start = self.time_since_start
+        if self.last_action and self.last_control is not None:
+            # on since the last control run, not accounted yet
+            time_since_start += (
+                util.clock.perf_counter() - self.last_control
             )
-            if day_changed:
-                self.custom_logger.save_daily_entry(
-                    self.settings["time_elapsed"],
-                    self.settings["last_day_on"]
-                )
-            # create async tasks
-            logger.debug("Asking temperature to thermometer...")
-            request_temperatures = asyncio.create_task(
-                self.thermometer.request_temperatures()
+        switch_age = None
+        if self.engine.last_switch is not None:
+            switch_age = util.clock.time() - self.engine.last_switch
+        program_key = (self.program.program_number, self.program.version)
+        cached = program_key == self.program_key
+        return snapshot.Snapshot(
+            util.clock.time(),
+            self.relay.stats,
+            switch_age,
+            time_since_start,
+            self.settings["room_temperature"],
+            str(self.program.program_number) if cached else None,
+            self.program.stat(),
+            self.program_now,
+            self.program_until if cached else 0,
+            self.sensors.ages()
+        )
+
+    def _restore_snapshot(self):
+        """Takes back the state of the last run, if recent enough:
+        readings, last relay switch, heater on time and program value."""
+        state = snapshot.read(self.settings["paths"]["snapshot"])
+        if state is None:
+            return
+        now = util.clock.time()
+        elapsed = now - state.written_at
+        if elapsed < 0:
+            logger.warning("Snapshot from the future, ignoring it.")
+            return
+        self.sensors.restore({
+            name: (value, age + elapsed)
+            for name, (value, age) in state.readings.items()
+        })
+        room_temperature = self.sensors.aggregate()
+        if (
+            self.settings["room_temperature"] is None
+            and room_temperature is not None
+        ):
+            # so that control doesn't wait for the sensor
+            self.settings_handler.handler(
+                {"temperatures": {"room": room_temperature}}
             )
-            if not self.settings["room_temperature"]:
-                try:
-                    temperature = await request_temperatures
-                # if no value for room_temperature and read from thermometer
-                # fails, retry endlessly without taking any other action
-                except (
-                    ThermometerLocalException,
-                    ThermometerLocalTimeout,
-                    ThermometerDirectException
-                ):
-                    self.settings["intervals"]["settings"]
-                    continue
-            # stop for given time in settings_file when relay_state changes
-            if diff_settings["relay_state"]:
-                stop = current["datetime"]
-                logger.debug("Stop at {}.".format(stop))
-            # but cancel stop if settings changes
-            mode_keys = {
-                "manual", "auto", "program", "desired_temp"
-            }
-            if any([diff_settings[k] for k in mode_keys]):
-                stop = False
-            # check if stop is expired
-            if stop:
-                stop_expired = util.stop_expired(current, stop, stop_time)
-            # do stuff if there's no stop or if stop is expired
-            if not stop or stop_expired:
-                action_task = asyncio.create_task(_handle_on_and_off(
-                    current, self.relay, **{
-                        k: v for k, v in self.settings.items()
-                        # unpacks only for params in func signature
-                        if k in _handle_on_and_off.__code__.co_varnames
-                    }
-                ))
-            # retrieve new_settings from UI and loop and write them to file
-            logger.debug("Just before await of temp")
-            try:  # TODO: multiple sensors logic
-                received_temperature = await request_temperatures
-                logger.info(
-                    "Received temperature: {}".format(received_temperature)
-                )
-                if (
-                    received_temperature
-                    != self.settings["room_temperature"]
-                ):
-                    self.new_settings.update(
-                        {"temperatures": {"room": received_temperature}}
-                    )
-            except (
-                ThermometerLocalException,
-                ThermometerLocalTimeout
-            ) as e:
-                logger.warning(
-                    "Could not retrieve temperatures from themometer."
+        self.time_since_start = state.time_since_start
+        switch_age = state.switch_age
+        if state.relay and not self.relay.stats:
+            # turned off while stopping: it counts as a switch
+            switch_age = 0
+        if switch_age is not None:
+            # the engine tells the first control run how long
+            # the relay has to stay off
+            self.engine.last_switch = now - (switch_age + elapsed)
+        self.program.select(self.settings["program"])
+        if (
+            state.program_number == str(self.program.program_number)
+            and state.program_stat == self.program.stat()
+            and now < state.program_until
+        ):
+            self.program_key = (
+                self.program.program_number, self.program.version
+            )
+            self.program_now = state.program_now
+            self.program_until = state.program_until
+        logger.info(
+            "Resumed from a snapshot written %.1f s ago.", elapsed
+        )
+
+    def _init_api(self):
+        """Local APIs, None if disabled in settings."""
+        configs = dict(self.settings["api_configs"])
+        if not configs.pop("enabled"):
+            return None
+        from local_api import LocalAPI, Response, json_response
+
+        def command(request, project_id, device_id):
+            # same payload as iottly's, e.g. {"cmd_type": "thermostat",
+            # "values": {"thermostat.command": "auto"}}
+            try:
+                cmd_type, values = request.json().values()
+                cmdpars = {k.split(".")[1]: v for k, v in values.items()}
+                self.post_command(cmd_type, cmdpars)
+            except (ValueError, AttributeError, IndexError) as e:
+                logger.warning("Bad local API command: {!r}".format(e))
+                return Response(status=400)
+            logger.info("Local API command: %s %s", cmd_type, cmdpars)
+            return Response()
+
+        def stats(request):
+            stats = self.stats()
+            return json_response(stats, 200 if stats else 404)
+
+        api = LocalAPI(**configs)
+        api.route(
+            "POST",
+            "/project/{project_id}/device/{device_id}/command",
+            command
+        )
+        api.route(
+            "GET",
+            "/instrumentation",
+            # per-phase timings in microseconds since start
+            lambda request: json_response(self.instrumentation.summary())
+        )
+        api.route(
+            "GET",
+            "/metrics",
+            lambda request: Response(
+                metrics.registry.render(),
+                content_type="text/plain; version=0.0.4"
+            )
+        )
+        api.route("GET", "/webhook/user", stats)
+        return api
+
+    async def _learn_thermal_model(self):
+        """Replaces the thermal model with one learnt from the
+        recorded history, fitted out of the loop thread."""
+        configs = self.settings["preheat_configs"]
+        now = util.clock.time()
+        history = self.timeseries.query(
+            now - configs["history_days"] * 86400, now, "1min"
+        )
+        model = _init_thermal_model(configs)
+        await asyncio.get_running_loop().run_in_executor(
+            None, model.fit, history
+        )
+        # observations since the query are lost, a few minutes at most
+        self.thermal = self.preheat.model = model
+        self.instrumentation.mark("thermal")
+        logger.info(
+            "Thermal model from %d samples: heating rate %s, "
+            "loss rate %s, outside %s.",
+            len(history["time"]),
+            model.heating_rate,
+            model.loss_rate,
+            model.outside
+        )
+
+    async def _start_services(self):
+        """Local APIs and cloud, once control is running.
+        Local APIs to close on exit go in self.api."""
+        await self.controlling.wait()
+        self.instrumentation.mark("first_control")
+        try:
+            api = self._init_api()
+            if api is not None:
+                await api.start()
+                self.api = api
+                self.instrumentation.mark("api")
+        except Exception:
+            logger.exception("Could not start local APIs.")
+        try:
+            await self._learn_thermal_model()
+        except Exception:
+            logger.exception("Could not learn the thermal model.")
+        if self.settings["thermometer_configs"]["cloud"]:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._init_cloud
                 )
-                self.iottly_sdk.send({"error": str(e)})
-            except ThermometerDirectException as e:
-                self.iottly_sdk.send({"error": str(e)})
-            logger.debug("Just before await of action")
-            action = await action_task
-            logger.info("Relay state: {}".format(action))
-
-            # FINISHED ACTION: sleep then update settings
-
-            # interval is X we need to sleep for
-            # X - time spent until now
-            # otherwise we will sleep for more than X
-            time_to_sleep = (
-                self.settings["intervals"]["settings"]
-                - (time.perf_counter() - start)
+            except Exception:
+                # the heater is still controlled, locally
+                logger.exception("Could not connect to the cloud.")
+        logger.info(
+            "Startup (seconds since start): %s",
+            ", ".join(
+                "{} {:.3f}".format(name, seconds)
+                for name, seconds in self.instrumentation.milestones.items()
             )
-            time.sleep(max(0, time_to_sleep - time_after_sleep))
-            after_sleep = time.perf_counter()
-            time_after_sleep = 0
-
-            # update elapsed time with heater on
-            if action:
-                self.time_since_start += time.perf_counter() - start
-            logger.debug("time_since_start: {}".format(self.time_since_start))
-            time_elapsed = 0
-            time_to_add = int(self.time_since_start)
-            self.time_since_start -= time_to_add
-            # self.time_since_start goes "backwards"
-            # so we need to reset it sometimes
-            if not time_to_add:
-                time_to_add = round(self.time_since_start)
-                self.time_since_start = 0
-            if time_to_add:
-                time_elapsed = util.increment_time_elapsed(
-                    self.settings, time_to_add
+        )
+
+    async def loop(self):
+        # relay switches, see _update_engine
+        self.engine = None
+        self.engine_key = None
+        self._update_engine()
+        self.control_timer = None
+        self.schedule_timer = None
+        self.program_now = None
+        # (program number, version) program_now was looked up for,
+        # valid until program_until (epoch seconds)
+        self.program_key = None
+        self.program_until = 0
+        # program intervals ahead, see _upcoming_targets
+        self.upcoming_key = None
+        self.upcoming = []
+        self.last_action = self.relay.stats
+        self.last_control = None
+        # target of the last control run, see _record_sample
+        self.target = None
+        scheduler = Loop(self.exit, self.instrumentation)
+        # each task on its own cadence, following changes in settings
+        for interval, task in (
+            ("sensor", self._poll_sensor),
+            ("settings", self._control),
+            ("files", self._watch_files),
+            ("persistence", self._persist),
+            ("sync", self._sync),
+            ("sample", self._record_sample),
+            ("timeseries", self._flush_timeseries),
+            ("instrumentation", self._log_instrumentation),
+            ("snapshot", self._write_snapshot),
+        ):
+            scheduler.every(
+                lambda interval=interval: (
+                    self.settings["intervals"][interval]
+                ),
+                task,
+                # nothing to summarize or to save at start
+                now=task not in (
+                    self._log_instrumentation, self._write_snapshot
                 )
-                logger.info("time_elapsed: {}".format(time_elapsed))
-            # update settings
-            if day_changed:
-                self.new_settings.update({
-                    "log": {
-                        "time_elapsed": "0:00:00",
-                        "last_day_on": current["formatted_date"]
-                    }
-                })
-            if time_elapsed:
-                self.new_settings.update({
-                    "log": {
-                        "time_elapsed": time_elapsed
-                    }
-                })
-            if self.new_settings:
-                # write only if there's a difference
-                # (even if this is already managed by SettingsHandler)
-                self.settings_handler.handler(self.new_settings)
-                self.new_settings = {}
-            time_after_sleep = time.perf_counter() - after_sleep
+            )
+        # control runs on every event, intervals["settings"] is
+        # only a fallback for time_elapsed accounting
+        self.bus.attach(asyncio.get_running_loop())
+        self._restore_snapshot()
+        for kind in events.kinds:
+            self.bus.subscribe(
+                kind, lambda kind, data: scheduler.trigger("_control")
+            )
+        # relay and sensors are up: control starts right away,
+        # the rest comes up in the background
+        self.controlling = asyncio.Event()
+        self.api = None
+        services = asyncio.create_task(self._start_services())
+        # start loop
+        logger.debug("Starting loop. Settings:\n%s", self.settings)
+        await scheduler.run()
+        # before the relay goes off, see _restore_snapshot
+        try:
+            snapshot.write(
+                self.settings["paths"]["snapshot"],
+                self._take_snapshot(),
+                fsync=True
+            )
+        except Exception:
+            logger.exception("Could not write snapshot.")
+        self._cancel_control_timer()
+        if self.schedule_timer is not None:
+            self.schedule_timer.cancel()
         # raise UnknownException('Exited main loop.')
+        # the heater goes off first, whatever services are doing
         self.relay.off()
         self.relay.clean()
+        if not self.controlling.is_set():
+            # stopped before the first control run
+            services.cancel()
+        # a cloud connection may hang: give up waiting after a while
+        done, _ = await asyncio.wait({services}, timeout=5)
+        if not done:
+            logger.warning("Services still starting, cancelling them.")
+            services.cancel()
+            await asyncio.wait({services})
+        if self.api is not None:
+            await self.api.close()
+        self.bus.detach()
+        self.sensors.close()
+        self.timeseries.close()
+        if self.sync_worker is not None:
+            self.sync_worker.stop()
+        self.settings_handler.close()
 
 
 def main():
     thermostat_exit = threading.Event()
     thermostat = Thermostat(thermostat_exit)
 
-    app = flask.Flask(__name__)
-
-    app.logger = logger
-
-    @app.route(
-        '/project/<projectID>/device/<deviceID>/command',
-        methods=["POST"]
-    )
-    def send_to_sdk(projectID, deviceID):
-        cmd_type, values = flask.request.json.values()
-        values = {k.split(".")[1]: v for k, v in values.items()}
-        data = {"data": {cmd_type: values}}
-        # data["data"] = flask.request.json
-        data = json.dumps(data)
-        logger.info("flask data: {}".format(data))
-        try:
-            thermostat.iottly_sdk._process_msg_from_agent(data)
-            resp = flask.Response("", status=200)
-            resp.headers['Access-Control-Allow-Origin'] = '192.168.1.27'
-            return resp
-        except:
-            return
-
-    @app.route('/webhook/user')
-    def return_stats():
-        stats = thermostat.stats
-        return_code = 200 if stats else 404
-        resp = flask.Response(thermostat.stats, status=return_code)
-        resp.headers['Access-Control-Allow-Origin'] = '192.168.1.27'
-        return resp
-
-    def run_thermostat():
-        asyncio.run(thermostat.loop())
-
-    thermostat_loop = threading.Thread(
-        target=run_thermostat, name='thermostat-loop'
-    )
-
     # signal handling
     def signal_handler(sig_number, sig_handler):
         off_signals = {
@@ -604,8 +1034,9 @@ def main():
         }
         if sig_number in off_signals:
             logger.info("{} received, shutting down...".format(sig_number))
+            # the loop stops, saves a snapshot and cleans up,
+            # see Thermostat.loop
             thermostat_exit.set()
-            exit()
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGSEGV, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -613,11 +1044,11 @@ def main():
     signal.signal(signal.SIGHUP, signal_handler)
 
     try:
-        # start the flask server for local APIs
-        thermostat_loop.start()
-        app.run(host="0.0.0.0")  # security first
+        # local APIs are served from the same event loop
+        asyncio.run(thermostat.loop())
     except Exception as e:
         thermostat.relay.clean()
+        thermostat.settings_handler.close()
         logger.exception(e)
         raise UnknownException(e)
 
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+import bisect
+import math
+
+
+# seconds, for latencies from a fraction of a millisecond
+# up to the slowest sensor timeouts
+default_buckets = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+class _Metric():
+
+    type = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # called at scrape time instead of keeping a value, see Gauge
+        self.func = func
+        # tuple of label values: value
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} takes labels {}, got {}'.format(
+                self.name, self.labels, tuple(labels)
+            ))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        '''
+        Yields (suffix, labels dict, value) of every series.
+        '''
+        if self.func is not None:
+            yield '', {}, self.func()
+            return
+        # list() copies the items in one step, writers don't
+        # have to wait for scrapes, nor scrapes for writers
+        for key, value in list(self.values.items()):
+            yield '', dict(zip(self.labels, key)), value
+
+    def render(self):
+        return render_family(self.name, self.help, self.type, self.samples())
+
+
+class Counter(_Metric):
+    '''
+    Monotonically increasing count, optionally by labels:
+
+        relay_toggles.inc(state='on')
+    '''
+
+    type = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(_Metric):
+    '''
+    Value that goes up and down. With func it is read
+    only when scraped, e.g. the length of a queue.
+    '''
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    '''
+    Distribution of observed values in cumulative buckets.
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # counts by bucket, the last one for +Inf, then sum
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for key, series in list(self.values.items()):
+            labels = dict(zip(self.labels, key))
+            series = list(series)
+            yield from histogram_samples(
+                labels, zip(self.buckets, series), series[-2], series[-1]
+            )
+
+
+def histogram_samples(labels, bucket_counts, inf_count, total):
+    '''
+    Yields the samples of a histogram series from the count of
+    values of each bucket, as (upper bound, count) pairs.
+    '''
+    seen = 0
+    for bound, count in bucket_counts:
+        seen += count
+        yield '_bucket', dict(labels, le=_format_value(bound)), seen
+    seen += inf_count
+    yield '_bucket', dict(labels, le='+Inf'), seen
+    yield '_sum', labels, total
+    yield '_count', labels, seen
+
+
+class Registry():
+    '''
+    In-memory metrics, rendered in the Prometheus text format.
+
+    Metrics are plain dicts updated without locks: the control
+    loop never waits for a scrape, and a scrape at worst misses
+    an update happening while it renders.
+    Collectors are callables returning extra lines at scrape time,
+    for values kept somewhere else (see Instrumentation.metrics).
+    '''
+
+    def __init__(self):
+        # name: metric, in registration order
+        self.metrics = {}
+        self.collectors = []
+
+    def _register(self, cls, name, *args, **kwargs):
+        # modules and thermostats created again reuse their metrics
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif kwargs.get('func') is not None:
+            metric.func = kwargs['func']
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self._register(Counter, name, help, labels, func=func)
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._register(Gauge, name, help, labels, func=func)
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        return self._register(
+            Histogram, name, help, labels, buckets=buckets
+        )
+
+    def collect(self, collector):
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        for collector in list(self.collectors):
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+def render_family(name, help, type, samples):
+    '''
+    Lines of a metric family from (suffix, labels, value) samples.
+    '''
+    lines = [
+        '# HELP {} {}'.format(name, help),
+        '# TYPE {} {}'.format(name, type),
+    ]
+    for suffix, labels, value in samples:
+        lines.append(_sample(name + suffix, labels, value))
+    return lines
+
+
+def _sample(name, labels, value):
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, _escape(label_value))
+            for label, label_value in labels.items()
+        ))
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    )
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    if value is None:
+        return 'NaN'
+    return str(value)
+
+
+# the thermostat's metrics, served at /metrics
+registry = Registry()
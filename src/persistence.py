@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import time
+
+import metrics
+
+
+logger_name = 'thermostat.persistence'
+logger = logging.getLogger(logger_name)
+
+fsync_policies = {'always', 'interval', 'shutdown'}
+
+store_writes = metrics.registry.counter(
+    'thermostat_settings_writes_total',
+    'Writes of journaled stores: journal appends and snapshots.',
+    ('kind',)
+)
+store_bytes = metrics.registry.counter(
+    'thermostat_settings_written_bytes_total',
+    'Bytes written to journaled stores.',
+    ('kind',)
+)
+
+
+def atomic_write(path, data, fsync=True):
+    '''
+    Replaces file at path with data (a string, or bytes) in a crash-safe
+    way: data is written to a temporary file which is renamed over path.
+    A power cut leaves either the old or the new file, never a truncated one.
+    '''
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync:
+        _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _stat_file(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class JournaledStore():
+    '''
+    JSON snapshot plus an append-only journal of changes.
+
+    Every change is appended to '<path>.journal' as one JSON line,
+    the snapshot is rewritten atomically only when the journal
+    is compacted, every compact_every entries or on close.
+
+    fsync policy for the journal:
+      always:   fsync after every append
+      interval: fsync at most every fsync_interval seconds
+      shutdown: fsync only when compacting or closing
+    '''
+
+    def __init__(
+        self,
+        path,
+        fsync='interval',
+        fsync_interval=30,
+        compact_every=1000
+    ):
+        self.path = path
+        self.journal_path = '{}.journal'.format(path)
+        self.configure(fsync, fsync_interval, compact_every)
+        self.journal_entries = 0
+        self._journal = None
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+        self._file_stat = None
+
+    def configure(self, fsync=None, fsync_interval=None, compact_every=None):
+        if fsync is not None:
+            if fsync not in fsync_policies:
+                raise ValueError(
+                    'fsync policy must be one of {}'.format(fsync_policies)
+                )
+            self.fsync = fsync
+        if fsync_interval is not None:
+            self.fsync_interval = fsync_interval
+        if compact_every is not None:
+            self.compact_every = compact_every
+
+    def exists(self):
+        return os.path.isfile(self.path) and os.stat(self.path).st_size
+
+    def stat(self):
+        '''
+        Identifies current state of snapshot and journal on disk.
+        '''
+        return (_stat_file(self.path), _stat_file(self.journal_path))
+
+    def changed(self):
+        '''
+        True if snapshot or journal were modified by someone else
+        since last load or write.
+        '''
+        return self.stat() != self._file_stat
+
+    def load(self):
+        '''
+        Returns the snapshot and the list of changes in the journal,
+        oldest first. A torn last line (crash during append) is discarded.
+        '''
+        with open(self.path) as f:
+            snapshot = json.load(f)
+        changes = []
+        if os.path.isfile(self.journal_path):
+            good_bytes = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('incomplete line')
+                        changes.append(json.loads(line))
+                    except ValueError:
+                        logger.warning(
+                            'Discarding corrupt tail of {}.'.format(
+                                self.journal_path
+                            )
+                        )
+                        break
+                    good_bytes += len(line)
+            if good_bytes != os.stat(self.journal_path).st_size:
+                # so that next appends don't end up after garbage
+                os.truncate(self.journal_path, good_bytes)
+        self.journal_entries = len(changes)
+        self._file_stat = self.stat()
+        return snapshot, changes
+
+    def append(self, changes, snapshot):
+        '''
+        Appends changes to the journal. snapshot is the full state
+        after changes, written only when the journal is compacted.
+        '''
+        if self.journal_entries >= self.compact_every:
+            self.compact(snapshot)
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        line = json.dumps(changes, separators=(',', ':')) + '\n'
+        self._journal.write(line)
+        self._journal.flush()
+        self.journal_entries += 1
+        self._unsynced = True
+        store_writes.inc(kind='journal')
+        store_bytes.inc(len(line), kind='journal')
+        if self.fsync == 'always':
+            self.sync()
+        else:
+            self.maybe_sync()
+        self._file_stat = self.stat()
+
+    def maybe_sync(self):
+        '''
+        fsyncs the journal if the interval policy says so.
+        '''
+        if (
+            self.fsync == 'interval'
+            and time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        if self._journal is not None and self._unsynced:
+            os.fsync(self._journal.fileno())
+            self._unsynced = False
+        self._last_sync = time.monotonic()
+
+    def compact(self, snapshot):
+        '''
+        Writes snapshot atomically, then empties the journal.
+        The journal is truncated in place, so that other processes
+        appending to it keep writing to the same file.
+        '''
+        data = json.dumps(snapshot, indent=2) + '\n'
+        atomic_write(self.path, data)
+        with open(self.journal_path, 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries = 0
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+        self._file_stat = self.stat()
+        store_writes.inc(kind='snapshot')
+        store_bytes.inc(len(data), kind='snapshot')
+        logger.debug('Compacted {}.'.format(self.journal_path))
+
+    def close(self, snapshot):
+        self.compact(snapshot)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
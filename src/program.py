@@ -1,16 +1,224 @@
 #!/usr/bin/python3
 
 import argparse
+import bisect
+import datetime
 import json
 import logging
 import os
 
+from persistence import atomic_write
 import util
 
 
 logger_name = 'thermostat'
 logger = logging.getLogger(logger_name)
 
+minutes_per_day = 1440
+
+
+def parse_time(value):
+    '''
+    Minutes since midnight from 'HH:MM' or from a number of minutes.
+    '24:00' is the end of the day.
+    '''
+    try:
+        if isinstance(value, str):
+            hours, minutes = value.split(':')
+            minutes = int(hours) * 60 + int(minutes)
+        else:
+            minutes = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid time of day: {!r}'.format(value))
+    if not 0 <= minutes <= minutes_per_day:
+        raise ValueError('Invalid time of day: {!r}'.format(value))
+    return minutes
+
+
+def format_time(minutes):
+    return '{:02}:{:02}'.format(*divmod(minutes, 60))
+
+
+class ProgramIndex():
+    '''
+    Sorted interval index of a program.
+
+    Every day is a list of starts (minutes since midnight, the first
+    one always 0) and the value in force from each start on, so point
+    queries are a bisect, O(log n) in the number of intervals.
+    Exception days (e.g. holidays) replace their weekday's schedule.
+
+    A program in program.json maps weekday names to either
+    the hourly format:
+        {"0": value, ..., "23": value}
+    or a list of intervals, later ones winning where they overlap:
+        [{"start": "06:30", "end": "08:15", "value": 21.5}, ...]
+    Time not covered by any interval takes the program's "default"
+    (False, heater off, if missing). Exception days go in "exceptions",
+    by ISO date, as one of the formats above or as the name of the
+    weekday whose schedule they follow:
+        "exceptions": {"2021-12-25": "sunday"}
+    '''
+
+    def __init__(self, program):
+        self.default = program.get('default', False)
+        self.week = [
+            parse_day(
+                program.get(util.days_of_week[weekday], {}), self.default
+            )
+            for weekday in range(7)
+        ]
+        self.exceptions = {}
+        for date, spec in program.get('exceptions', {}).items():
+            date = datetime.date.fromisoformat(date)
+            if isinstance(spec, str):
+                self.exceptions[date] = self.week[_weekday(spec)]
+            else:
+                self.exceptions[date] = parse_day(spec, self.default)
+        self.last_exception = max(self.exceptions, default=None)
+
+    def day(self, date):
+        '''
+        (starts, values) in force on given date.
+        '''
+        day = self.exceptions.get(date)
+        if day is None:
+            day = self.week[date.weekday()]
+        return day
+
+    def value_at(self, when):
+        starts, values = self.day(when.date())
+        return values[
+            bisect.bisect_right(starts, when.hour * 60 + when.minute) - 1
+        ]
+
+    def next_transition(self, when):
+        '''
+        Datetime of the first start after given datetime
+        where the value changes, None if it never does.
+        '''
+        value = self.value_at(when)
+        date = when.date()
+        minute = when.hour * 60 + when.minute
+        # a week without changes means no changes at all,
+        # unless there are exception days ahead
+        last = date + datetime.timedelta(days=8)
+        if self.last_exception is not None and self.last_exception >= last:
+            last = self.last_exception + datetime.timedelta(days=1)
+        while date <= last:
+            starts, values = self.day(date)
+            for i in range(bisect.bisect_right(starts, minute), len(starts)):
+                if not _same_value(values[i], value):
+                    return datetime.datetime.combine(
+                        date, datetime.time()
+                    ) + datetime.timedelta(minutes=starts[i])
+            date += datetime.timedelta(days=1)
+            # from the next day on midnight counts as well
+            minute = -1
+        return None
+
+    def between(self, start, end):
+        '''
+        Returns (from, to, value) for every stretch of constant value
+        between two datetimes, e.g. what happens in the next hours.
+        '''
+        stretches = []
+        when = start
+        while when < end:
+            transition = self.next_transition(when)
+            until = end if transition is None else min(transition, end)
+            stretches.append((when, until, self.value_at(when)))
+            when = until
+        return stretches
+
+
+def parse_day(spec, default):
+    '''
+    (starts, values) of a day of program.json in either format.
+    '''
+    if isinstance(spec, dict):
+        intervals = [
+            (int(hour) * 60, int(hour) * 60 + 60, value)
+            for hour, value in spec.items()
+        ]
+    else:
+        intervals = [
+            (
+                parse_time(interval['start']),
+                parse_time(interval['end']),
+                interval['value']
+            )
+            for interval in spec
+        ]
+    return paint([0], [default], intervals)
+
+
+def set_interval(program, day, start, end, value):
+    '''
+    Sets value from start to end (minutes since midnight) of day
+    in a program dict. day is a weekday name, or an ISO date for an
+    exception day, which starts as a copy of its weekday.
+    Days in the hourly format stay hourly as long as possible.
+    '''
+    if day in util.days_of_week.values():
+        container, key = program, day
+        spec = program.get(day, {})
+    else:
+        date = datetime.date.fromisoformat(day)
+        container = program.setdefault('exceptions', {})
+        key = date.isoformat()
+        spec = container.get(key, util.days_of_week[date.weekday()])
+        if isinstance(spec, str):
+            spec = program.get(util.days_of_week[_weekday(spec)], {})
+    if isinstance(spec, dict) and start % 60 == 0 and end % 60 == 0:
+        spec = dict(spec)
+        for hour in range(start // 60, end // 60):
+            spec[str(hour)] = value
+    else:
+        default = program.get('default', False)
+        starts, values = paint(
+            *parse_day(spec, default), [(start, end, value)]
+        )
+        ends = starts[1:] + [minutes_per_day]
+        spec = [
+            {
+                'start': format_time(start),
+                'end': format_time(end),
+                'value': value
+            }
+            for start, end, value in zip(starts, ends, values)
+            if not _same_value(value, default)
+        ]
+    container[key] = spec
+
+
+def paint(starts, values, intervals):
+    '''
+    Returns (starts, values) after writing each (start, end, value)
+    of intervals over them, in order. Adjacent equal values are merged.
+    '''
+    for start, end, value in intervals:
+        if start >= end:
+            continue
+        after = None
+        if end < minutes_per_day:
+            after = values[bisect.bisect_right(starts, end) - 1]
+        i = bisect.bisect_left(starts, start)
+        j = bisect.bisect_right(starts, end)
+        starts = starts[:i] + [start] + starts[j:]
+        values = values[:i] + [value] + values[j:]
+        if after is not None:
+            starts.insert(i + 1, end)
+            values.insert(i + 1, after)
+    merged_starts, merged_values = [], []
+    for start, value in zip(starts, values):
+        if merged_values and _same_value(merged_values[-1], value):
+            continue
+        merged_starts.append(start)
+        merged_values.append(value)
+    return merged_starts, merged_values
+
+
 class Program(object):
 
     def __init__(self, program_number, program_path, examples_path):
@@ -27,9 +235,89 @@ class Program(object):
             with open(self.program_path, 'w') as w:
                 w.write(json.dumps(program_example))
 
+        self.program_number = program_number
+        self._file_stat = None
+        # incremented at every change of the compiled table,
+        # to invalidate values cached from it
+        self.version = 0
+        self.reload()
+
+    def reload(self):
+        '''
+        Reads program.json and compiles the selected program
+        into an in-memory lookup table.
+        '''
         self.programs = self.read_program()
+        self._file_stat = self._stat_program()
+        self.program = self.load_program(self.program_number)
+        self._compile()
+
+    def reload_if_changed(self):
+        '''
+        Reloads program.json only if its inode, mtime or size changed
+        since it was last read or written.
+        Returns True if the program was reloaded.
+        '''
+        if self._stat_program() == self._file_stat:
+            return False
+        logger.info('{} changed, reloading.'.format(self.program_path))
+        self.reload()
+        return True
+
+    def select(self, program_number):
+        '''
+        Switches to another program already in memory.
+        '''
+        if str(program_number) == str(self.program_number):
+            return
         self.program = self.load_program(program_number)
         self.program_number = program_number
+        self._compile()
+
+    def target_at(self, when):
+        '''
+        Returns the program value at given datetime.
+        '''
+        return self.index.value_at(when)
+
+    def next_transition(self, when):
+        '''
+        Returns the datetime of the first interval start after given
+        datetime where the program value changes,
+        None if the program never changes.
+        '''
+        return self.index.next_transition(when)
+
+    def between(self, start, end):
+        '''
+        Returns (from, to, value) for every stretch of constant value
+        between start and end datetimes.
+        '''
+        return self.index.between(start, end)
+
+    def _compile(self):
+        self.index = self.compile_program(self.program)
+        self.version += 1
+
+    @staticmethod
+    def compile_program(program):
+        '''
+        Builds the interval index of a program, in either format.
+        '''
+        return ProgramIndex(program)
+
+    def stat(self):
+        '''
+        Identifies program.json as it was last read or written.
+        '''
+        return self._file_stat
+
+    def _stat_program(self):
+        try:
+            stat = os.stat(self.program_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
     def load_program(self, program_number):
 
@@ -75,12 +363,8 @@ class Program(object):
         except ValueError:
             ValueError(invalid_hour_message)
 
-        self.programs = self.read_program()
-        # check program number exists
-        if program_number not in self.programs:
-            raise KeyError('Could not find specified program number.')
-
         # edit the configuration
+        changes = []
         for day in days:
             # d = d.lower().replace(' ', '')
             # check day
@@ -90,10 +374,67 @@ class Program(object):
                 assert hour in {
                     str(el) for el in range(24)
                 }, invalid_hour_message
-                # insert value
-                self.programs[program_number][day][hour] = value
+                changes.append((day, hour, value))
+
+        return self.edit_slots(program_number, changes)
+
+    def edit_interval(self, program_number, days, start, end, value):
+        '''
+        Sets value from start to end of given days in a program.
+
+        :param days:     Weekday names or ISO dates of exception days.
+                         Can be a list or a string
+        :param start:    'HH:MM' or minutes since midnight
+        :param end:      'HH:MM' or minutes since midnight, '24:00' max
+        '''
+        if not isinstance(days, list):
+            days = [days]
+        return self.edit_slots(
+            program_number, [(day, start, end, value) for day in days]
+        )
 
-        self.write_program(self.programs)
+    def edit_slots(self, program_number, changes):
+        '''
+        Applies many changes to a program with a single write,
+        e.g. a drag across a whole day in the app.
+        Nothing is applied if any change is invalid.
+
+        :param changes:  (day, hour, value) or (day, start, end, value)
+                         tuples, day being a weekday name or the ISO date
+                         of an exception day
+        Returns what changed as {path: value}, ready for a multi-path
+        update: '0/monday/7' for hours of days in the hourly format,
+        '0/monday' or '0/exceptions/2021-12-25' for whole days.
+        '''
+        program_number = str(program_number)
+        intervals = [_parse_change(change) for change in changes]
+        self.reload_if_changed()
+        if program_number not in self.programs:
+            raise KeyError('Could not find specified program number.')
+        previous = self.programs[program_number]
+        program = json.loads(json.dumps(previous))
+        for day, start, end, value in intervals:
+            set_interval(program, day, start, end, value)
+        changed = {}
+        for day in {day for day, _, _, _ in intervals}:
+            if day in util.days_of_week.values():
+                path, old, new = day, previous.get(day), program[day]
+            else:
+                path = 'exceptions/{}'.format(day)
+                old = previous.get('exceptions', {}).get(day)
+                new = program['exceptions'][day]
+            if isinstance(old, dict) and isinstance(new, dict):
+                changed.update({
+                    '{}/{}/{}'.format(program_number, path, hour): value
+                    for hour, value in new.items()
+                    if not _same_value(old.get(hour), value)
+                })
+            elif old != new:
+                changed['{}/{}'.format(program_number, path)] = new
+        if changed:
+            self.programs[program_number] = program
+            self.write_program(self.programs)
+        return changed
 
     def add_program(mode='new', program_number=None):
 
@@ -140,9 +481,58 @@ class Program(object):
 
     def write_program(self, program):
 
-        with open(self.program_path, 'w') as f:
-            json.dump(program, f, indent=2)
-            f.write("\n")
+        atomic_write(self.program_path, json.dumps(program, indent=2))
+        # keep the compiled table in sync without reading the file back
+        self.programs = program
+        self._file_stat = self._stat_program()
+        self.program = self.load_program(self.program_number)
+        self._compile()
+
+
+def _parse_change(change):
+    '''
+    (day, start, end, value) of a change given to Program.edit_slots.
+    '''
+    if len(change) == 3:
+        day, hour, value = change
+        try:
+            start = int(hour) * 60
+        except (TypeError, ValueError):
+            start = -1
+        if not 0 <= start < minutes_per_day:
+            raise ValueError(
+                "Argument 'hour' should be a number between 0 and 23"
+            )
+        end = start + 60
+    else:
+        day, start, end, value = change
+        start, end = parse_time(start), parse_time(end)
+        if start >= end:
+            raise ValueError('Interval must end after it starts.')
+    try:
+        day = day.lower().replace(' ', '')
+        if day not in util.days_of_week.values():
+            day = datetime.date.fromisoformat(day).isoformat()
+    except (AttributeError, ValueError):
+        raise ValueError(
+            'Please enter a valid day of the week'
+            ' (English, case insensitive) or an ISO date'
+        )
+    return day, start, end, value
+
+
+def _weekday(day):
+    for weekday, name in util.days_of_week.items():
+        if name == day.lower().replace(' ', ''):
+            return weekday
+    raise ValueError(
+        'Please enter a valid day of the week (English, case insensitive)'
+    )
+
+
+def _same_value(a, b):
+    # True (desired_temp) is not the same as 1 degree
+    return a == b and isinstance(a, bool) == isinstance(b, bool)
 
 
 def main():
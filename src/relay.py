@@ -4,26 +4,35 @@ import datetime
 import json
 import logging
 import os
-import RPi.GPIO as GPIO
 import signal
-import time
 
+import hardware
+import metrics
 from settings_handler import SettingsHandler
 
 
 logger_name = 'thermostat.relay'
 logger = logging.getLogger(logger_name)
 
+toggles = metrics.registry.counter(
+    'thermostat_relay_toggles_total',
+    'Relay switches, by new state.',
+    ('state',)
+)
+
 
 class Relay(object):
 
-    def __init__(self, relay, settings_handler):
+    def __init__(self, relay, settings_handler, gpio=None):
         '''
         Takes a dictionary containing what GPIO.setup needs as first argument
         plus path to thermostat settings to write relay state at each operation
 
         relay dict:
         channel, direction {0,1}, initial {0,1}
+
+        gpio is the hardware backend (see hardware module),
+        the Raspberry Pi's if None.
         '''
 
         self.pin = str(relay['channel'])
@@ -32,57 +41,53 @@ class Relay(object):
         else:
             self.stats = False
         self.settings_handler = settings_handler
+        self.gpio = gpio if gpio is not None else hardware.RPiGPIO()
 
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(**relay)
+        self.gpio.setup(**relay)
 
     def on(self):
 
         if not self.stats:
-            GPIO.output(int(self.pin), GPIO.LOW)
+            self.gpio.output(int(self.pin), self.gpio.LOW)
+            toggles.inc(state='on')
 
             wrote_stats = self.write_stats(True)
 
             if wrote_stats == True:
-                logger.debug(f'Turned ON channel {self.pin}.')
+                logger.debug('Turned ON channel %s.', self.pin)
             else:
                 logger.warning('Fault while writing stats.')
 
             self.update_stats(wrote_stats)
 
         else:
-            logger.warning(
-                f'Channel {self.pin} was already set to ON.'
-                ' Shutting down and restarting...'
-            )
-            self.off()
-            time.sleep(1)
-            self.on()
+            logger.debug('Channel %s was already set to ON.', self.pin)
 
         return self.stats
 
     def off(self):
 
         if self.stats:
-            GPIO.output(int(self.pin), GPIO.HIGH)
+            self.gpio.output(int(self.pin), self.gpio.HIGH)
+            toggles.inc(state='off')
 
             wrote_stats = self.write_stats(False)
 
             if wrote_stats == False:
-                logger.debug(f'Turned OFF channel {self.pin}.')
+                logger.debug('Turned OFF channel %s.', self.pin)
             else:
                 logger.warning('Fault while writing stats.')
 
             self.update_stats(wrote_stats)
 
         else:
-            logger.debug(f'Channel {self.pin} was already OFF.')
+            logger.debug('Channel %s was already OFF.', self.pin)
 
         return self.stats
 
     def clean(self):
 
-        GPIO.cleanup(int(self.pin))
+        self.gpio.cleanup(int(self.pin))
 
         wrote_stats = self.write_stats(False)
 
@@ -107,7 +112,10 @@ class Relay(object):
         Writes new stats to file then reads the file again and returns it.
         '''
 
-        logger.debug("Writing new stats: {}".format(new_stats))
+        logger.debug("Writing new stats: %s", new_stats)
+        if self.settings_handler is None:
+            # nowhere to write, e.g. in simulations
+            return new_stats
         settings = self.settings_handler.handler(
             settings_changes={
                 'relay': {
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+import asyncio
+import logging
+import statistics
+import time
+
+from exceptions import InvalidSettingsException
+from hardware import SimulatedThermometer
+import metrics
+from thermometer import ThermometerDirect, ThermometerLocal
+
+
+logger_name = 'thermostat.sensors'
+logger = logging.getLogger(logger_name)
+
+latency = metrics.registry.histogram(
+    'thermostat_sensor_latency_seconds',
+    'Time taken by good readings, by sensor type.',
+    ('type',)
+)
+failures = metrics.registry.counter(
+    'thermostat_sensor_failures_total',
+    'Failed readings, by sensor type and error (timeout or exception).',
+    ('type', 'error')
+)
+
+# seconds waited for a reading after the thermometer's own timeouts
+timeout_margin = 0.1
+
+aggregate_policies = {
+    'mean': statistics.mean,
+    'median': statistics.median,
+    'min': min,
+    'max': max,
+}
+
+
+class Sensor():
+    """
+    A thermometer with its last good reading.
+    """
+
+    def __init__(self, name, thermometer, timeout, zone=None, kind=None):
+        self.name = name
+        self.thermometer = thermometer
+        self.timeout = timeout
+        self.zone = zone
+        # w1, udp or simulated, for metrics
+        self.kind = kind
+        self.value = None
+        # time.monotonic() of last good reading
+        self.updated = None
+
+    async def poll(self):
+        started = time.monotonic()
+        try:
+            value = await asyncio.wait_for(
+                self.thermometer.request_temperatures(), self.timeout
+            )
+        except asyncio.TimeoutError:
+            failures.inc(type=self.kind, error='timeout')
+            raise
+        except Exception as e:
+            failures.inc(type=self.kind, error=type(e).__name__)
+            raise
+        self.value = value
+        self.updated = time.monotonic()
+        latency.observe(self.updated - started, type=self.kind)
+        return value
+
+
+class SensorRegistry():
+    """
+    Polls any mix of 1-Wire and UDP thermometers concurrently
+    and aggregates their last good readings.
+
+    Policies: mean, median, min, max over all sensors,
+    or zone: mean over sensors of the given zone only.
+    Readings older than max_age seconds are ignored.
+    """
+
+    def __init__(self, sensors, aggregate='mean', zone=None, max_age=300):
+        if aggregate not in aggregate_policies and aggregate != 'zone':
+            raise InvalidSettingsException(
+                'Unknown aggregate policy: {}'.format(aggregate)
+            )
+        self.sensors = sensors
+        self.aggregate_policy = aggregate
+        self.zone = zone
+        self.max_age = max_age
+
+    @classmethod
+    def from_settings(cls, configs, intervals, room=None):
+        """
+        Builds sensors from configs["sensors"], a list like
+        [{"name": "room", "type": "w1", "device": "28-...", "zone": "day"},
+         {"name": "kitchen", "type": "udp", "ip": "...", "port": 4210}]
+        When it's empty, a single sensor is built from the
+        legacy 'direct', 'UDP_IP' and 'UDP_port' configs.
+        "simulated" sensors read room (a hardware.RoomModel).
+        """
+        if configs["backend"] == "simulated":
+            default_type = "simulated"
+        else:
+            default_type = "w1" if configs["direct"] else "udp"
+        sensors_configs = configs["sensors"] or [{
+            "name": "room",
+            "type": default_type,
+            "ip": configs["UDP_IP"],
+            "port": configs["UDP_port"],
+        }]
+        sensors = []
+        for sensor_configs in sensors_configs:
+            sensor_type = sensor_configs.get("type", "udp")
+            if sensor_type == "w1":
+                thermometer = ThermometerDirect(
+                    sensor_configs.get("device"),
+                    configs["discovery_interval"]
+                )
+            elif sensor_type == "udp":
+                thermometer = ThermometerLocal(
+                    sensor_configs["ip"],
+                    sensor_configs["port"],
+                    intervals["temperature"],
+                    sensor_configs.get("retries", configs["retries"]),
+                    sensor_configs.get("backoff", configs["backoff"])
+                )
+            elif sensor_type == "simulated" and room is not None:
+                thermometer = SimulatedThermometer(
+                    room, sensor_configs.get("noise", 0)
+                )
+            else:
+                raise InvalidSettingsException(
+                    'Unknown sensor type: {}'.format(sensor_type)
+                )
+            # never keep the control decision waiting, but give
+            # retrying thermometers the time to give up on their own
+            timeout = max(
+                intervals["sensor"],
+                getattr(thermometer, "max_duration", 0) + timeout_margin
+            )
+            sensors.append(Sensor(
+                sensor_configs.get("name", str(len(sensors))),
+                thermometer,
+                sensor_configs.get("timeout", timeout),
+                sensor_configs.get("zone"),
+                sensor_type
+            ))
+        return cls(
+            sensors,
+            configs["aggregate"],
+            configs["zone"],
+            configs["max_age"]
+        )
+
+    async def poll(self):
+        """
+        Polls all sensors at once.
+        Returns a dict of sensor name: exception for failed ones.
+        """
+        results = await asyncio.gather(
+            *[sensor.poll() for sensor in self.sensors],
+            return_exceptions=True
+        )
+        return {
+            sensor.name: result
+            for sensor, result in zip(self.sensors, results)
+            if isinstance(result, Exception)
+        }
+
+    def readings(self):
+        """
+        Last good readings not older than max_age, by sensor name.
+        """
+        now = time.monotonic()
+        return {
+            sensor.name: sensor.value
+            for sensor in self.sensors
+            if sensor.updated is not None
+            and now - sensor.updated <= self.max_age
+        }
+
+    def ages(self):
+        """
+        Every last good reading with its age in seconds,
+        by sensor name, e.g. for a snapshot.
+        """
+        now = time.monotonic()
+        return {
+            sensor.name: (sensor.value, now - sensor.updated)
+            for sensor in self.sensors
+            if sensor.updated is not None
+        }
+
+    def restore(self, ages):
+        """
+        Takes back readings given by ages(), unless sensors
+        were read since.
+        """
+        now = time.monotonic()
+        for sensor in self.sensors:
+            if sensor.name in ages and sensor.updated is None:
+                sensor.value, age = ages[sensor.name]
+                sensor.updated = now - age
+
+    def zones(self):
+        """
+        Mean temperature for each zone having recent readings.
+        """
+        readings = self.readings()
+        zones = {}
+        for sensor in self.sensors:
+            if sensor.name in readings:
+                zones.setdefault(sensor.zone, []).append(
+                    readings[sensor.name]
+                )
+        return {
+            zone: round(statistics.mean(values), 2)
+            for zone, values in zones.items()
+        }
+
+    def aggregate(self):
+        """
+        Aggregated temperature, None if no sensor has a recent reading.
+        """
+        if self.aggregate_policy == 'zone':
+            return self.zones().get(self.zone)
+        values = list(self.readings().values())
+        if not values:
+            return None
+        return round(aggregate_policies[self.aggregate_policy](values), 2)
+
+    def close(self):
+        for sensor in self.sensors:
+            sensor.thermometer.close()
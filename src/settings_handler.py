@@ -5,6 +5,7 @@ import json
 import logging
 import os
 
+from persistence import JournaledStore, atomic_write
 import util
 
 
@@ -33,16 +34,36 @@ default_settings = {
     "global": os.path.join(parent_directory, "logs/global.json"),
     "iottly": "/opt/iottly.com-agent",
     "program": os.path.join(parent_directory, "programs/program.json"),
-    "relay_stat": os.path.join(parent_directory, "settings/stats.json")
+    "relay_stat": os.path.join(parent_directory, "settings/stats.json"),
+    "timeseries": os.path.join(parent_directory, "logs/timeseries"),
+    "outbox": os.path.join(parent_directory, "settings/outbox.json"),
+    "snapshot": os.path.join(parent_directory, "settings/state.bin")
   },
   "configs": {
     "UDP_IP": "127.0.0.1",
     "UDP_port": 2222,
-    "direct": True
+    "retries": 1,
+    "backoff": 0.1,
+    "direct": True,
+    "backend": "rpi",
+    "cloud": True,
+    "sensors": [],
+    "aggregate": "mean",
+    "zone": None,
+    "max_age": 300,
+    "discovery_interval": 600
   },
   "intervals": {
-    "settings": 1,
+    "settings": 60,
+    "files": 2,
+    "sensor": 1,
     "temperature": 0.5,
+    "persistence": 5,
+    "sync": 1,
+    "sample": 1,
+    "timeseries": 60,
+    "instrumentation": 300,
+    "snapshot": 10,
     "stop_time": 170
   },
   "relay": {
@@ -50,6 +71,46 @@ default_settings = {
     "direction": 0,
     "initial": 1,
     "state": False
+  },
+  "timeseries": {
+    "1s": 86400,
+    "1min": 7776000,
+    "1h": 315360000
+  },
+  "firebase": {
+    "max_rate": 1,
+    "max_backoff": 300,
+    "max_pending": 1000
+  },
+  "api": {
+    "enabled": True,
+    "host": "0.0.0.0",
+    "port": 5000,
+    "allow_origin": "192.168.1.27",
+    "keepalive_timeout": 15
+  },
+  "control": {
+    "strategy": "bang_bang",
+    "hysteresis": [0.0, 0.0],
+    "min_on": None,
+    "min_off": None,
+    "max_cycles_per_hour": None,
+    "period": 900,
+    "band": 1.0,
+    "kp": 0.5,
+    "ki": 0.5
+  },
+  "preheat": {
+    "enabled": True,
+    "max_lead": 10800,
+    "history_days": 7,
+    "interval": 300,
+    "forgetting": 0.999
+  },
+  "persistence": {
+    "fsync": "interval",
+    "fsync_interval": 30,
+    "compact_every": 1000
   }
 }
 
@@ -148,88 +209,317 @@ def main(time_elapsed=None):
             )
         }
     }
-    return settings_handler.handler(
+    settings = settings_handler.handler(
         settings_changes=settings_changes
     )
+    settings_handler.close()
+    return settings
 
 class SettingsHandler():
 
     def __init__(self, settings_path):
         self.settings_path = settings_path
+        # authoritative copy of the settings file
+        self.settings = None
+        # changes not flushed to file yet
+        self.pending = {}
+        self.store = JournaledStore(settings_path)
+        # changes whenever settings are read from file, see refresh
+        self.version = 0
+        # called with changes made through handler
+        self.subscribers = []
+
+    def refresh(self):
+        '''
+        Reads 'setting.json' again only if it was edited from outside
+        (e.g. from this module's CLI), otherwise settings stay in memory.
+        Returns the version of the settings, which changes whenever
+        they are read from file, so that callers can skip copying them
+        when it doesn't and follow changes through subscribe.
+        '''
+        if self.settings is None or self.store.changed():
+            self.settings = self.read_settings()
+            if self.pending:
+                # external edit while we had changes waiting to be flushed
+                self.settings = _merge_settings(self.settings, self.pending)
+            self.version += 1
+        return self.version
 
     def load_settings(self):
         '''
-        Return setting in 'setting.json' file in a python dictionary.
+        Return settings in a python dictionary.
+        '''
+        self.refresh()
+        return _copy_settings(self.settings)
+
+    def read_settings(self):
+        '''
+        Return setting in 'setting.json' file, with changes
+        from its journal applied, in a python dictionary.
         '''
-        if (
-            not os.path.isfile(self.settings_path) or
-            not os.stat(self.settings_path).st_size
-        ):
+        if not self.store.exists():
             logger.info('{} not found, creating.'.format(self.settings_path))
             settings_parent = os.path.split(self.settings_path)[0]
             if not os.path.isdir(settings_parent):
                 os.mkdir(settings_parent)
-            with open(self.settings_path, 'w') as f:
-                json.dump(default_settings, f, indent=2)
+            atomic_write(
+                self.settings_path, json.dumps(default_settings, indent=2)
+            )
             logger.debug('Created new settings.json file from example.')
-        with open(self.settings_path) as f:
-            settings_file = json.load(f)
+        settings_file, journal = self.store.load()
+        # fields missing from the file take values from default_settings
+        settings_file = _merge_settings(default_settings, settings_file)
+        for changes in journal:
+            settings_file = _merge_settings(settings_file, changes)
+        self.store.configure(**settings_file.get(
+            'persistence', default_settings['persistence']
+        ))
         return settings_file
 
-    def update_settings(self, settings_changes, settings_file):
+    def flush(self):
         '''
-        Write settings_changes to 'setting.json' file, only
-        if there are differences.
-        Returns contents of the file in a python dictionary.
+        Appends all changes since last flush to the journal
+        of 'setting.json' in a single write.
+        Returns True if anything was written.
         '''
-        if settings_changes != settings_file:
-            with open(self.settings_path, 'w') as f:
-                json.dump(settings_changes, f, indent=2)
-                f.write('\n')
-            logger.debug('Settings changed!')
-        else:
-            logger.debug('Settings not changed.')
-        return self.load_settings()
+        if not self.pending:
+            self.store.maybe_sync()
+            return False
+        self.store.append(self.pending, self.settings)
+        self.pending = {}
+        logger.debug('Flushed settings to %s.', self.settings_path)
+        return True
+
+    def close(self):
+        '''
+        Compacts the journal into 'setting.json' and syncs it to disk.
+        To be called on shutdown.
+        '''
+        if self.settings is None:
+            return
+        self.pending = {}
+        self.store.close(self.settings)
+
+    def subscribe(self, callback):
+        '''
+        callback(changes) is called by handler with the fields that
+        changed, by section: {'relay': {'state': True}}.
+        Changes from outside (see refresh) are not notified.
+        '''
+        self.subscribers.append(callback)
 
     def handler(self, settings_changes={}):
         '''
-        Sends updates to update_settings function.
-        Returns contents of 'settings.json' after updates
-        in a python dictionary.
-        '''
-        settings_file = self.load_settings()
-        logger.debug('Settings file read: {}'.format(settings_file))
-        logger.debug('Settings before update: {}'.format(settings_changes))
-        # add missing fields to settings_file from default_settings
-        settings_file = {
-            k:( # take outer from default_settings if not in settings_file
-                {kk:v for kk, v in default_settings[k].items()}
-                if k not in settings_file
-                else { # if exists in both go deeper
-                    kk:( # if kk not in settings_file, v from default_Settings
-                        v if kk not in settings_file[k]
-                        # else from settings_file
-                        else settings_file[k][kk]
-                    ) for kk, v in default_settings[k].items()
-                }
-            ) for k in default_settings
-        }
-        # nested dict update of settings_changes
-        settings_changes = {
-            k:( # take outer from settings_file if not in settings_changes
-                {kk:v for kk, v in settings_file[k].items()}
-                if k not in settings_changes
-                else { # if exists in both go deeper
-                    kk:( # if kk not in settings_changes, v from settings_file
-                        v if kk not in settings_changes[k]
-                        # else from settings_changes
-                        else settings_changes[k][kk]
-                    ) for kk, v in settings_file[k].items()
-                }
-            ) for k in settings_file
+        Applies settings_changes, by section, to settings in memory.
+        Only fields existing in default_settings are taken, and
+        only those that differ are kept for the next flush and
+        notified to subscribers, so the work is proportional to
+        the changes, not to the size of the settings.
+        Returns settings after updates, not to be modified.
+        '''
+        self.refresh()
+        changes = {}
+        for section, values in settings_changes.items():
+            defaults = default_settings.get(section)
+            if not isinstance(defaults, dict):
+                continue
+            current = self.settings[section]
+            changed = {
+                k: v for k, v in values.items()
+                if k in defaults and (k not in current or current[k] != v)
+            }
+            if changed:
+                changes[section] = changed
+        if not changes:
+            logger.debug('Settings not changed.')
+            return self.settings
+        for section, changed in changes.items():
+            # a new dict, copies from load_settings stay as they were
+            self.settings[section] = dict(self.settings[section], **changed)
+        # remember only changed fields, so that an external edit
+        # of other fields in the same section is not overwritten
+        self.pending = _merge_settings(self.pending, changes)
+        logger.debug('Settings changed: %s', changes)
+        for callback in self.subscribers:
+            callback(changes)
+        return self.settings
+
+
+class SettingsState():
+    '''
+    Flat view of the settings the thermostat works with, e.g.
+    settings.desired_temp or settings["desired_temp"].
+
+    Fields follow SettingsHandler changes through apply, setting
+    only the fields that changed; load sets them all, after the
+    settings file was edited from outside.
+    Setting a field to a different value marks it dirty; publish()
+    hands the fields changed since its previous call to the
+    subscribers interested in them, so nothing has to be copied and
+    compared field by field to find out what changed.
+    Values are replaced, never changed in place.
+    '''
+
+    # name: accepted types, every field is None until set
+    fields = {
+        "log": dict,
+        "mode": dict,
+        "manual": bool,
+        "auto": bool,
+        # program.json key, a number if edited by hand
+        "program": (str, int),
+        "desired_temp": (int, float),
+        "paths": dict,
+        "intervals": dict,
+        "firebase_configs": dict,
+        "api_configs": dict,
+        "control_configs": dict,
+        "preheat_configs": dict,
+        "relay_configs": dict,
+        "retention": dict,
+        "relay_state": bool,
+        "room_temperature": (int, float),
+        "thermometer_configs": dict,
+        "loglevel": str,
+        "last_day_on": str,
+        "time_elapsed": str,
+        # looked up in program.json, a temperature or a bool
+        "program_target_temperature": (bool, int, float),
+    }
+    __slots__ = tuple(fields) + ('_dirty', '_subscribers')
+    # name: dirty bit
+    _bits = {name: 1 << i for i, name in enumerate(fields)}
+    # settings file section: field holding all of it
+    _sections = {
+        "log": "log",
+        "mode": "mode",
+        "paths": "paths",
+        "intervals": "intervals",
+        "firebase": "firebase_configs",
+        "api": "api_configs",
+        "control": "control_configs",
+        "preheat": "preheat_configs",
+        "relay": "relay_configs",
+        "timeseries": "retention",
+        "configs": "thermometer_configs",
+    }
+    # (section, key) of the settings file: field
+    _keys = {
+        ("mode", "manual"): "manual",
+        ("mode", "auto"): "auto",
+        ("mode", "program"): "program",
+        ("mode", "desired_temp"): "desired_temp",
+        ("relay", "state"): "relay_state",
+        ("temperatures", "room"): "room_temperature",
+        ("log", "loglevel"): "loglevel",
+        ("log", "last_day_on"): "last_day_on",
+        ("log", "time_elapsed"): "time_elapsed",
+    }
+
+    def __init__(self):
+        object.__setattr__(self, '_dirty', 0)
+        object.__setattr__(self, '_subscribers', [])
+        for name in self.fields:
+            object.__setattr__(self, name, None)
+
+    def __setattr__(self, name, value):
+        bit = self._bits.get(name)
+        if bit is not None:
+            if value is not None and not isinstance(value, self.fields[name]):
+                raise TypeError('{} can not be {!r}'.format(name, value))
+            if getattr(self, name) != value:
+                object.__setattr__(self, '_dirty', self._dirty | bit)
+        object.__setattr__(self, name, value)
+
+    def __getitem__(self, name):
+        if name not in self._bits:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self._bits
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self._bits else default
+
+    def __repr__(self):
+        return repr({name: getattr(self, name) for name in self.fields})
+
+    def load(self, settings):
+        '''
+        Sets all fields from the settings file, as load_settings
+        returns it.
+        '''
+        for section, name in self._sections.items():
+            setattr(self, name, settings[section])
+        for (section, key), name in self._keys.items():
+            setattr(self, name, settings[section][key])
+
+    def apply(self, changes):
+        '''
+        Sets the fields affected by changes to the settings file,
+        as SettingsHandler.subscribe passes them.
+        '''
+        for section, values in changes.items():
+            name = self._sections.get(section)
+            if name is not None:
+                setattr(self, name, dict(getattr(self, name), **values))
+            for key, value in values.items():
+                name = self._keys.get((section, key))
+                if name is not None:
+                    setattr(self, name, value)
+
+    def subscribe(self, callback, fields=None):
+        '''
+        callback(changes) is called by publish with a dict of the
+        given fields (all if None) that changed, if any did.
+        '''
+        mask = 0
+        for name in (self.fields if fields is None else fields):
+            mask |= self._bits[name]
+        self._subscribers.append((mask, callback))
+
+    def publish(self):
+        '''
+        Sends changes since the previous call to subscribers.
+        Returns all of them.
+        '''
+        dirty = self._dirty
+        if not dirty:
+            return {}
+        object.__setattr__(self, '_dirty', 0)
+        changes = {
+            name: getattr(self, name)
+            for name, bit in self._bits.items() if dirty & bit
         }
-        logger.debug('Settings after update: {}'.format(settings_changes))
-        return self.update_settings(settings_changes, settings_file)
+        for mask, callback in self._subscribers:
+            if dirty & mask:
+                callback({
+                    name: value for name, value in changes.items()
+                    if self._bits[name] & mask
+                })
+        return changes
+
+
+def _copy_settings(settings):
+    return {
+        k: dict(v) if isinstance(v, dict) else v
+        for k, v in settings.items()
+    }
+
+
+def _merge_settings(settings, changes):
+    '''
+    Nested (two levels) update of settings with changes.
+    Returns a new dictionary.
+    '''
+    merged = _copy_settings(settings)
+    for k, v in changes.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k].update(v)
+        else:
+            merged[k] = v
+    return merged
 
 
 if __name__ == '__main__':
@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import time
+
+import numpy as np
+
+import control
+from hardware import RoomModel, SimulatedGPIO
+from program import Program
+from relay import Relay
+import util
+
+
+class VirtualClock():
+    '''
+    Clock for util.set_clock, moved forward by the simulation.
+    '''
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+    def perf_counter(self):
+        return self.elapsed
+
+
+class Simulation():
+    '''
+    Discrete-event simulation of the control loop on a virtual clock.
+
+    Program lookups and decisions of the control engine (control
+    module) run exactly like in the loop, one decision per tick.
+    Between events (a decision that changes the relay, the end of
+    a minimum on/off time or of a time-proportional pulse,
+    a program transition) the room follows the first order model
+    of hardware.RoomModel with the heater fixed, computed for all
+    ticks of the stretch at once with NumPy, so only ticks where
+    something happens are visited.
+    engine defaults to bang-bang without hysteresis, with
+    stop_time as minimum on and off time.
+
+    outside is the outside temperature: a number, or a sequence
+    of hourly values repeated over the simulation.
+    '''
+
+    def __init__(
+        self,
+        program,
+        manual=False,
+        auto=True,
+        desired_temp=20.0,
+        stop_time=170,
+        room=None,
+        outside=None,
+        start=None,
+        tick=1,
+        engine=None
+    ):
+        self.program = program
+        self.manual = manual
+        self.auto = auto
+        self.desired_temp = desired_temp
+        self.stop_time = stop_time
+        self.room = room if room is not None else RoomModel()
+        self.outside = self.room.outside if outside is None else outside
+        self.start = start if start is not None else datetime.datetime(
+            2021, 1, 4  # a monday
+        )
+        self.tick = tick
+        self.engine = engine
+        self.temperatures = None
+
+    def outside_at(self, seconds):
+        if util.is_number(self.outside):
+            return self.outside
+        return self.outside[int(seconds // 3600) % len(self.outside)]
+
+    def run(self, duration, record=False):
+        '''
+        Simulates duration seconds. When record is True,
+        room temperature at every tick is kept in self.temperatures.
+        Returns a report of heater on time, relay cycles and comfort.
+        '''
+        clock = VirtualClock(self.start)
+        previous_clock = util.set_clock(clock)
+        try:
+            return self._run(clock, duration, record)
+        finally:
+            util.set_clock(previous_clock)
+
+    def _run(self, clock, duration, record):
+        wall_start = time.perf_counter()
+        ticks = int(duration // self.tick)
+        relay = Relay(
+            {'channel': 0, 'direction': 0, 'initial': 1}, None, SimulatedGPIO()
+        )
+        temperature = self.room.temperature
+        if record:
+            self.temperatures = np.empty(ticks + 1)
+            self.temperatures[0] = temperature
+        engine = self.engine or control.ControlEngine(
+            control.BangBang(), self.stop_time, self.stop_time
+        )
+        # temperature dependent strategies switch at a threshold,
+        # the others only at times they tell
+        threshold = getattr(engine.strategy, 'threshold', None)
+        events = 0
+        cycles = 0
+        heater_on_ticks = 0
+        temperature_sum = 0.0
+        max_overshoot = -math.inf
+        degree_hours_below = 0.0
+        # overshoot counts within a stretch of constant target,
+        # once the heater ran in it: not while the room cools down
+        # to a lower target
+        overshoot_target = None
+        heated = False
+        k = 0
+        while k < ticks:
+            events += 1
+            # the engine runs on seconds since start, exact for ticks
+            seconds = k * self.tick
+            clock.elapsed = seconds
+            current = util.get_now()
+            program_now = self.program.target_at(current['datetime'])
+            target = control.target_temperature(
+                self.manual, self.auto, program_now, self.desired_temp
+            )
+            on, wake_at = engine.decide(
+                seconds, temperature, target, relay.stats
+            )
+            if on != relay.stats:
+                if on:
+                    relay.on()
+                    cycles += 1
+                else:
+                    relay.off()
+                engine.switched(seconds, on)
+            if target != overshoot_target:
+                overshoot_target = target
+                heated = False
+            heated = heated or relay.stats
+            # next change of program or outside temperature
+            to_boundary = 3600 - seconds % 3600
+            transition = self.program.next_transition(current['datetime'])
+            if transition is not None:
+                to_boundary = min(to_boundary, (
+                    transition - current['datetime']
+                ).total_seconds())
+            if threshold is None and wake_at is not None:
+                to_boundary = min(to_boundary, wake_at - seconds)
+            n = min(ticks - k, max(1, math.ceil(to_boundary / self.tick)))
+            # room temperature at ticks k + 1 ... k + n, heater fixed
+            equilibrium = (
+                self.outside_at(seconds)
+                + relay.stats * self.room.heating_rate / self.room.loss_rate
+            )
+            temperatures = equilibrium + (temperature - equilibrium) * np.exp(
+                -self.room.loss_rate * self.tick * np.arange(1, n + 1)
+            )
+            # first tick at which a decision would switch the relay
+            if threshold is None:
+                flips = np.zeros(n, dtype=bool)
+            elif target is None:
+                flips = np.full(n, relay.stats)
+            else:
+                flips = temperatures < threshold(target, relay.stats)
+                flips = flips != relay.stats
+            locked_until = engine.locked_until(seconds, relay.stats)
+            if locked_until is not None:
+                flips &= (k + np.arange(1, n + 1)) * self.tick > locked_until
+            if flips.any():
+                n = int(np.argmax(flips)) + 1
+                temperatures = temperatures[:n]
+            heater_on_ticks += relay.stats * n
+            temperature_sum += float(temperatures.sum())
+            if target is not None:
+                if heated:
+                    max_overshoot = max(
+                        max_overshoot, float(temperatures.max()) - target
+                    )
+                degree_hours_below += float(np.clip(
+                    target - temperatures, 0, None
+                ).sum()) * self.tick / 3600
+            if record:
+                self.temperatures[k + 1:k + 1 + n] = temperatures
+            temperature = float(temperatures[-1])
+            k += n
+        heater_on_seconds = heater_on_ticks * self.tick
+        return {
+            'simulated_seconds': ticks * self.tick,
+            'wall_seconds': time.perf_counter() - wall_start,
+            'events': events,
+            'heater_on': util.format_seconds(heater_on_seconds),
+            'heater_on_seconds': heater_on_seconds,
+            'relay_cycles': cycles,
+            'max_overshoot': (
+                None if max_overshoot == -math.inf else round(max_overshoot, 3)
+            ),
+            'degree_hours_below_target': round(degree_hours_below, 3),
+            'mean_temperature': round(temperature_sum / max(ticks, 1), 3),
+            'final_temperature': round(temperature, 3),
+        }
+
+
+# finest granularity of UTC offsets in use, so that the offset
+# is the same for all timestamps in a bucket of this size
+_bucket_seconds = 900
+# 1970-01-01 was a thursday
+_epoch_weekday = 3
+_epoch = datetime.date(1970, 1, 1)
+
+
+def local_days_and_minutes(timestamps):
+    '''
+    Local days since 1970-01-01 and minutes since local midnight
+    of an array of epoch seconds.
+    The UTC offset is looked up once per distinct bucket of
+    _bucket_seconds, so a year of 1s samples costs 35040 lookups.
+    '''
+    timestamps = np.asarray(timestamps, dtype=float)
+    buckets, inverse = np.unique(
+        np.floor_divide(timestamps, _bucket_seconds), return_inverse=True
+    )
+    offsets = np.fromiter(
+        (
+            datetime.datetime.fromtimestamp(
+                bucket * _bucket_seconds
+            ).astimezone().utcoffset().total_seconds()
+            for bucket in buckets
+        ),
+        dtype=float,
+        count=len(buckets)
+    )
+    local = timestamps + offsets[inverse.reshape(-1)]
+    days = np.floor_divide(local, 86400).astype(np.int64)
+    minutes = ((local - days * 86400) // 60).astype(np.int64)
+    return days, minutes
+
+
+def program_targets(program, days, minutes, desired_temp):
+    '''
+    Target temperatures of a program at given local days and minutes
+    (see local_days_and_minutes): True becomes desired_temp,
+    False (heater off) becomes NaN.
+    program can be a Program or a program dict from program.json.
+    '''
+    index = getattr(program, 'index', None)
+    if index is None:
+        index = Program.compile_program(program)
+    week_starts = np.concatenate([
+        np.asarray(starts) + weekday * 1440
+        for weekday, (starts, _) in enumerate(index.week)
+    ])
+    week_values = np.concatenate([
+        _target_values(values, desired_temp) for _, values in index.week
+    ])
+    # programs have a resolution of one minute: a dense table
+    # of the week indexed by minute is exact and cheap to index
+    week = week_values[np.searchsorted(
+        week_starts, np.arange(7 * 1440), side='right'
+    ) - 1]
+    targets = week[(days + _epoch_weekday) % 7 * 1440 + minutes]
+    for date, (starts, values) in index.exceptions.items():
+        mask = days == (date - _epoch).days
+        if mask.any():
+            targets[mask] = _target_values(values, desired_temp)[
+                np.searchsorted(starts, minutes[mask], side='right') - 1
+            ]
+    return targets
+
+
+def _target_values(values, desired_temp):
+    return np.array([
+        desired_temp if value is True
+        else math.nan if value is False
+        else value
+        for value in values
+    ], dtype=float)
+
+
+def evaluate_programs(
+    programs,
+    timestamps,
+    temperatures,
+    desired_temp=20.0,
+    stop_time=None
+):
+    '''
+    Evaluates programs in auto mode against a temperature trace,
+    e.g. the columns of TimeSeriesStore.query.
+
+    temperatures has the shape of timestamps, or one row per program
+    to give each program its own scenario.
+    Returns (targets, relay): arrays of shape
+    (len(programs), len(timestamps)), targets NaN where the heater
+    is off, relay True where the heater would be on.
+    Without stop_time relay is the decision at each sample;
+    with it, decisions are held for stop_time seconds
+    after each switch like in the loop.
+    '''
+    timestamps = np.asarray(timestamps, dtype=float)
+    days, minutes = local_days_and_minutes(timestamps)
+    targets = np.stack([
+        program_targets(program, days, minutes, desired_temp)
+        for program in programs
+    ])
+    with np.errstate(invalid='ignore'):
+        relay = np.asarray(temperatures, dtype=float) < targets
+    if stop_time is not None:
+        relay = np.stack([
+            hold_decisions(decisions, timestamps, stop_time)
+            for decisions in relay
+        ])
+    return targets, relay
+
+
+def hold_decisions(decisions, timestamps, stop_time):
+    '''
+    Relay states resulting from a vector of decisions when,
+    like in the loop, no decision is taken until stop_time seconds
+    after each switch.
+    Visits only the switches.
+    '''
+    n = len(decisions)
+    # plain lists: bisect on them is much faster than
+    # np.searchsorted called once per switch
+    candidates = (
+        np.flatnonzero(~decisions).tolist(),
+        np.flatnonzero(decisions).tolist()
+    )
+    times = timestamps.tolist()
+    toggles = np.zeros(n, dtype=np.int8)
+    state = False
+    k = 0
+    while k < n:
+        # first decision from k on differing from the relay state
+        wanted = candidates[not state]
+        j = bisect.bisect_left(wanted, k)
+        if j == len(wanted):
+            break
+        i = wanted[j]
+        toggles[i] = 1
+        state = not state
+        k = bisect.bisect_right(times, times[i] + stop_time)
+    return np.cumsum(toggles) % 2 == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Simulates the thermostat on a virtual clock'
+            ' and reports heater on time, relay cycles and comfort.'
+        )
+    )
+    parser.add_argument('program_path', help='Path to program.json.')
+    parser.add_argument('-p', '--program', default='0')
+    parser.add_argument('-d', '--days', type=float, default=7)
+    parser.add_argument(
+        '-m', '--manual', action='store_true',
+        help='Manual mode instead of auto.'
+    )
+    parser.add_argument('-t', '--desired-temp', type=float, default=20.0)
+    parser.add_argument(
+        '-s', '--stop-time', type=float, default=170,
+        help='Minimum on and off time of the relay.'
+    )
+    parser.add_argument(
+        '--strategy', choices=sorted(control.strategies),
+        default='bang_bang'
+    )
+    parser.add_argument(
+        '--hysteresis', type=float, nargs=2, default=[0.0, 0.0],
+        metavar=('BELOW', 'ABOVE'),
+        help='Band around the target for bang_bang.'
+    )
+    parser.add_argument('--max-cycles', type=int, default=None)
+    parser.add_argument(
+        '--period', type=float, default=900,
+        help='Cycle of time_proportional and pi, in seconds.'
+    )
+    parser.add_argument('--band', type=float, default=1.0)
+    parser.add_argument('--kp', type=float, default=0.5)
+    parser.add_argument('--ki', type=float, default=0.5)
+    parser.add_argument('--start-temp', type=float, default=18.0)
+    parser.add_argument(
+        '--outside', type=float, nargs='+', default=[5.0],
+        help='Outside temperature, or 24 hourly values.'
+    )
+    parser.add_argument('--heating-rate', type=float, default=0.002)
+    parser.add_argument('--loss-rate', type=float, default=0.0001)
+    args = parser.parse_args()
+    simulation = Simulation(
+        Program(args.program, args.program_path, None),
+        manual=args.manual,
+        auto=not args.manual,
+        desired_temp=args.desired_temp,
+        stop_time=args.stop_time,
+        room=RoomModel(
+            temperature=args.start_temp,
+            heating_rate=args.heating_rate,
+            loss_rate=args.loss_rate
+        ),
+        outside=args.outside if len(args.outside) > 1 else args.outside[0],
+        engine=control.engine_from_settings(
+            {
+                "strategy": args.strategy,
+                "hysteresis": args.hysteresis,
+                "min_on": None,
+                "min_off": None,
+                "max_cycles_per_hour": args.max_cycles,
+                "period": args.period,
+                "band": args.band,
+                "kp": args.kp,
+                "ki": args.ki,
+            },
+            args.stop_time
+        )
+    )
+    print(json.dumps(simulation.run(args.days * 86400), indent=2))
+
+
+if __name__ == '__main__':
+    main()
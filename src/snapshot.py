@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import logging
+import math
+import mmap
+import os
+import struct
+import zlib
+
+from persistence import atomic_write
+
+
+logger_name = 'thermostat.snapshot'
+logger = logging.getLogger(logger_name)
+
+magic = b'THSN'
+version = 1
+
+# magic, version, payload length, crc32 of payload
+_header = struct.Struct('<4sHII')
+# written_at, relay, switch_age, time_since_start, room_temperature,
+# program file (inode, mtime_ns, size), program_now (kind, value),
+# program_until
+_state = struct.Struct('<d?dddQqqBdd')
+_length = struct.Struct('<H')
+_name = struct.Struct('<B')
+# value, age
+_reading = struct.Struct('<dd')
+
+# kinds of program values
+_none, _false, _true, _number = range(4)
+
+
+class Snapshot():
+    '''
+    Control state needed to resume right after a restart.
+
+    Times are ages in seconds at written_at (clock.time()), so that
+    they can be brought to the present whatever the clock did:
+      switch_age:  since the last relay switch, None if free to switch
+      readings:    sensor name: (value, seconds since it was read)
+    time_since_start is heater on time not added to time_elapsed yet.
+    program_stat identifies program.json as it was when
+    program_now and program_until (epoch seconds) were looked up.
+    '''
+
+    def __init__(
+        self,
+        written_at,
+        relay,
+        switch_age=None,
+        time_since_start=0,
+        room_temperature=None,
+        program_number=None,
+        program_stat=None,
+        program_now=None,
+        program_until=0,
+        readings=None
+    ):
+        self.written_at = written_at
+        self.relay = relay
+        self.switch_age = switch_age
+        self.time_since_start = time_since_start
+        self.room_temperature = room_temperature
+        self.program_number = program_number
+        self.program_stat = program_stat
+        self.program_now = program_now
+        self.program_until = program_until
+        self.readings = readings or {}
+
+    def pack(self):
+        '''
+        Little-endian binary: a header with length and crc32,
+        fixed size state, then variable length fields.
+        '''
+        kind, value = _pack_value(self.program_now)
+        parts = [_state.pack(
+            self.written_at,
+            bool(self.relay),
+            _pack_float(self.switch_age),
+            self.time_since_start,
+            _pack_float(self.room_temperature),
+            *(self.program_stat or (0, 0, 0)),
+            kind,
+            value,
+            self.program_until
+        )]
+        parts.append(_pack_string(self.program_number or ''))
+        parts.append(_length.pack(len(self.readings)))
+        for name, (value, age) in self.readings.items():
+            parts.append(_pack_string(name))
+            parts.append(_reading.pack(_pack_float(value), age))
+        payload = b''.join(parts)
+        return _header.pack(
+            magic, version, len(payload), zlib.crc32(payload)
+        ) + payload
+
+    @classmethod
+    def unpack(cls, buffer):
+        '''
+        Snapshot from a buffer (bytes or mmap) written by pack.
+        Raises ValueError if it is not valid.
+        '''
+        if len(buffer) < _header.size:
+            raise ValueError('truncated header')
+        file_magic, file_version, length, crc = _header.unpack_from(buffer)
+        if file_magic != magic or file_version != version:
+            raise ValueError('unknown format')
+        if len(buffer) != _header.size + length:
+            raise ValueError('truncated payload')
+        payload = memoryview(buffer)[_header.size:]
+        try:
+            if zlib.crc32(payload) != crc:
+                raise ValueError('bad crc32')
+            return cls._unpack_payload(payload)
+        except struct.error as e:
+            raise ValueError(str(e))
+        finally:
+            payload.release()
+
+    @classmethod
+    def _unpack_payload(cls, payload):
+        (
+            written_at, relay, switch_age, time_since_start,
+            room_temperature, inode, mtime_ns, size, kind, value,
+            program_until
+        ) = _state.unpack_from(payload)
+        offset = _state.size
+        program_number, offset = _unpack_string(payload, offset)
+        count, = _length.unpack_from(payload, offset)
+        offset += _length.size
+        readings = {}
+        for _ in range(count):
+            name, offset = _unpack_string(payload, offset)
+            reading, age = _reading.unpack_from(payload, offset)
+            offset += _reading.size
+            readings[name] = (_unpack_float(reading), age)
+        return cls(
+            written_at,
+            relay,
+            _unpack_float(switch_age),
+            time_since_start,
+            _unpack_float(room_temperature),
+            program_number or None,
+            (inode, mtime_ns, size) if size else None,
+            _unpack_value(kind, value),
+            program_until,
+            readings
+        )
+
+
+def write(path, snapshot, fsync=False):
+    '''
+    Replaces the snapshot at path. Without fsync a power cut can
+    leave an empty or torn file, which read discards.
+    '''
+    atomic_write(path, snapshot.pack(), fsync=fsync)
+
+
+def read(path):
+    '''
+    Snapshot at path, memory-mapped and validated.
+    None if missing or not valid, then the thermostat starts cold.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError('empty file')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return Snapshot.unpack(m)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('Discarding snapshot {}: {}'.format(path, e))
+        return None
+
+
+def _pack_float(value):
+    return math.nan if value is None else value
+
+
+def _unpack_float(value):
+    return None if math.isnan(value) else value
+
+
+def _pack_value(value):
+    # program values are temperatures or booleans (heater off/on)
+    if value is None:
+        return _none, 0.0
+    if isinstance(value, bool):
+        return (_true if value else _false), 0.0
+    return _number, value
+
+
+def _unpack_value(kind, value):
+    return {_none: None, _false: False, _true: True}.get(kind, value)
+
+
+def _pack_string(string):
+    data = string.encode()[:255]
+    return _name.pack(len(data)) + data
+
+
+def _unpack_string(payload, offset):
+    length, = _name.unpack_from(payload, offset)
+    offset += _name.size
+    data = bytes(payload[offset:offset + length])
+    if len(data) != length:
+        raise ValueError('truncated string')
+    return data.decode(), offset + length
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+import json
+import os
+import tempfile
+
+from hardware import RoomModel
+from program import Program
+from simulation import Simulation
+
+weekdays = (
+    'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+    'sunday'
+)
+
+
+def step_program(directory):
+    # 21 until 1:00, then 16
+    path = os.path.join(directory, 'program.json')
+    day = {str(hour): 21 if hour < 1 else 16 for hour in range(24)}
+    with open(path, 'w') as f:
+        json.dump({'0': {weekday: day for weekday in weekdays}}, f)
+    return Program('0', path, None)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        program = step_program(directory)
+        # above the target all along: the heater never runs,
+        # the room cooling down to 16 is not overshoot
+        report = Simulation(
+            program, room=RoomModel(temperature=22.0, loss_rate=0.00001)
+        ).run(2 * 3600)
+        print(report)
+        assert report['heater_on_seconds'] == 0
+        assert report['max_overshoot'] is None
+        # heating up to 21 first: overshoot of the lockout only
+        report = Simulation(
+            program, room=RoomModel(temperature=18.0)
+        ).run(2 * 3600)
+        print(report)
+        assert 0 <= report['max_overshoot'] <= 0.002 * 170
+
+
+if __name__ == '__main__':
+    main()
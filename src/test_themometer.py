@@ -3,7 +3,7 @@
 import asyncio
 import time
 
-from exceptions import ThermometerTimeout
+from exceptions import ThermometerLocalTimeout
 from thermometer import ThermometerLocal
 
 async def main(retries=0):
@@ -17,7 +17,7 @@ async def main(retries=0):
         print(retries)
         try:
             temperature = await temperature_task
-        except ThermometerTimeout:
+        except ThermometerLocalTimeout:
             retries += 1
     return temperature, retries
 
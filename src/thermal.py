@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import logging
+import math
+
+
+logger_name = 'thermostat.thermal'
+logger = logging.getLogger(logger_name)
+
+
+class ThermalModel():
+    '''
+    First order thermal model of the room, like hardware.RoomModel:
+        dT/dt = heating_rate * heater - loss_rate * (T - outside)
+    learnt online by recursive least squares from room temperature
+    and heater state, as
+        dT/dt = a * heater + b * T + c
+    with a = heating_rate, b = -loss_rate, c = loss_rate * outside,
+    rates in degrees (and 1) per hour to keep numbers well scaled.
+
+    Observations are averaged over interval seconds (temperature
+    changes of a few seconds are all sensor noise). forgetting
+    weighs older intervals less, so that the model follows seasons:
+    0.999 every 5 minutes halves the weight of a sample in 2.4 days.
+    Memory is three parameters and a 3x3 matrix.
+    '''
+
+    def __init__(
+        self,
+        interval=300,
+        forgetting=0.999,
+        min_updates=24,
+        max_trace=1e4
+    ):
+        self.interval = interval
+        self.forgetting = forgetting
+        # updates before predictions are trusted
+        self.min_updates = min_updates
+        # forgetting stops when the covariance grows this much,
+        # e.g. with the room held at the same temperature for days
+        self.max_trace = max_trace
+        self.theta = [0.0, 0.0, 0.0]
+        self.covariance = [
+            [100.0 if i == j else 0.0 for j in range(3)] for i in range(3)
+        ]
+        self.updates = 0
+        # start of the current interval: (time, temperature)
+        self.start = None
+        # time of the previous observation
+        self.previous = None
+        # heater seconds since start
+        self.heater_seconds = 0.0
+
+    def observe(self, timestamp, temperature, heater):
+        '''
+        Room temperature at timestamp (epoch seconds), heater
+        whether (or the fraction of time) the heater was on since
+        the previous observation.
+        Gaps longer than interval start a new interval.
+        '''
+        if temperature is None or math.isnan(temperature):
+            self.start = None
+            return
+        if (
+            self.start is None
+            or not 0 <= timestamp - self.previous <= self.interval
+        ):
+            self._restart(timestamp, temperature)
+            return
+        self.heater_seconds += heater * (timestamp - self.previous)
+        self.previous = timestamp
+        start, start_temperature = self.start
+        elapsed = timestamp - start
+        if elapsed < self.interval:
+            return
+        hours = elapsed / 3600
+        self.update(
+            self.heater_seconds / elapsed,
+            (start_temperature + temperature) / 2,
+            (temperature - start_temperature) / hours
+        )
+        self._restart(timestamp, temperature)
+
+    def _restart(self, timestamp, temperature):
+        self.start = (timestamp, temperature)
+        self.previous = timestamp
+        self.heater_seconds = 0.0
+
+    def update(self, heater, temperature, slope):
+        '''
+        One least squares step: the room temperature changed at
+        slope degrees per hour around temperature, with the heater
+        on for the given fraction of the time.
+        '''
+        x = (heater, temperature, 1.0)
+        p = self.covariance
+        px = [sum(p[i][j] * x[j] for j in range(3)) for i in range(3)]
+        trace = p[0][0] + p[1][1] + p[2][2]
+        forgetting = self.forgetting if trace < self.max_trace else 1.0
+        gain = [v / (forgetting + sum(a * b for a, b in zip(x, px)))
+                for v in px]
+        error = slope - sum(t * v for t, v in zip(self.theta, x))
+        self.theta = [t + g * error for t, g in zip(self.theta, gain)]
+        self.covariance = [
+            [(p[i][j] - gain[i] * px[j]) / forgetting for j in range(3)]
+            for i in range(3)
+        ]
+        self.updates += 1
+
+    def fit(self, history):
+        '''
+        Learns from recorded history: a dict of arrays with 'time',
+        'room_temperature' and 'relay' (fraction of the sample
+        the heater was on), like TimeSeriesStore.query returns.
+        '''
+        heater = 0.0
+        for timestamp, temperature, relay in zip(
+            history['time'], history['room_temperature'], history['relay']
+        ):
+            # relay of a sample tells about the time until the next one
+            self.observe(timestamp, temperature, heater)
+            heater = 0.0 if math.isnan(relay) else relay
+
+    def ready(self):
+        '''
+        True when the model learnt enough for predictions:
+        the heater warms the room, which cools down on its own.
+        '''
+        return (
+            self.updates >= self.min_updates
+            and self.theta[0] > 0
+            and self.theta[1] < 0
+        )
+
+    @property
+    def heating_rate(self):
+        '''Degrees per second with the heater on, None if not ready.'''
+        return self.theta[0] / 3600 if self.ready() else None
+
+    @property
+    def loss_rate(self):
+        '''Fraction of the difference with outside lost per second.'''
+        return -self.theta[1] / 3600 if self.ready() else None
+
+    @property
+    def outside(self):
+        '''Temperature the room tends to with the heater off.'''
+        return -self.theta[2] / self.theta[1] if self.ready() else None
+
+    def time_to_reach(self, temperature, target):
+        '''
+        Seconds of heating to bring the room from temperature to
+        target, math.inf if the heater can't, None if not ready.
+        '''
+        if not self.ready():
+            return None
+        if temperature >= target:
+            return 0.0
+        a, b, c = self.theta
+        equilibrium = -(a + c) / b
+        if equilibrium <= target:
+            return math.inf
+        return math.log(
+            (equilibrium - temperature) / (equilibrium - target)
+        ) / -b * 3600
+
+
+class Preheat():
+    '''
+    Optimum start: in auto mode the heater starts before a program
+    interval, at the latest time that still gets the room to its
+    target when the interval begins, according to the model.
+    Starting as late as possible keeps the heater on for the least
+    time; pre-heating never starts more than max_lead seconds early.
+    '''
+
+    def __init__(self, model, max_lead=10800):
+        self.model = model
+        self.max_lead = max_lead
+        # start of the program interval being pre-heated for,
+        # kept until it begins so that the heater doesn't stop
+        # as soon as the room gets ahead of schedule
+        self.preheating = None
+
+    def target(self, now, temperature, target, upcoming):
+        '''
+        Returns (target, wake_at): target raised to the one of an
+        upcoming interval when it's time to start heating for it,
+        and when to check again, None if nothing is coming.
+        upcoming is a list of (start, target) in epoch seconds,
+        target None when the heater is off.
+        '''
+        if self.preheating is not None and now >= self.preheating:
+            self.preheating = None
+        wake_at = None
+        for start, upcoming_target in upcoming:
+            if start <= now or upcoming_target is None:
+                continue
+            if start - now > self.max_lead:
+                break
+            if target is not None and upcoming_target <= target:
+                continue
+            lead = self.model.time_to_reach(temperature, upcoming_target)
+            if lead is None:
+                # nothing learnt yet: the program as it is
+                break
+            lead = min(lead, self.max_lead)
+            if start == self.preheating or now >= start - lead:
+                if self.preheating is None or start < self.preheating:
+                    logger.info(
+                        'Pre-heating to %s, %.0f s before the program.',
+                        upcoming_target, start - now
+                    )
+                    self.preheating = start
+                target = upcoming_target
+            elif wake_at is None or start - lead < wake_at:
+                wake_at = start - lead
+        return target, wake_at
@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
+import asyncio
+import concurrent.futures
 import json
 import logging
 import os
-import socket
+import time
 
 from exceptions import (
     InvalidSettingsException,
@@ -13,60 +15,139 @@ from exceptions import (
 )
 
 
+logger_name = 'thermostat.thermometer'
+logger = logging.getLogger(logger_name)
+
+
 class ConfigurationError(BaseException):
     pass
 
 
+class _ThermometerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, thermometer):
+        self.thermometer = thermometer
+
+    def datagram_received(self, data, addr):
+        self.thermometer._response_received(data)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the request will time out
+        logger.debug("UDP error from thermometer: %s", exc)
+
+    def connection_lost(self, exc):
+        self.thermometer.transport = None
+
+
 class ThermometerLocal():
     """
     Class that handles temperature request from sensor
-    attached to wifi transmitter in same network
+    attached to wifi transmitter in same network.
+
+    One UDP endpoint stays open on the event loop, requests carry a
+    sequence number that the sensor echoes back in its reply,
+    so late replies to timed out requests are told apart.
     """
 
-    def __init__(self, ip, port, timeout):
+    def __init__(self, ip, port, timeout, retries=0, backoff=0):
         self.ip = ip
         try:
             self.port = int(port)
         except ValueError as e:
             raise InvalidSettingsException(e)
-        # build UDP socket
-        self.thermometer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.thermometer.settimeout(timeout)
-        self.thermometer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    async def _parse_temperatures(self, data, measure):
-        """Async json.loads wrapper for async temperature request"""
-        temperature = json.loads(data)
-
-        return temperature[measure]
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # longest a request can take before it gives up
+        self.max_duration = timeout * (retries + 1) + sum(
+            backoff * 2 ** attempt for attempt in range(retries)
+        )
+        self.transport = None
+        self.sequence = 0
+        # sequence number: future waiting for the reply
+        self.pending = {}
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ThermometerProtocol(self),
+            remote_addr=(self.ip, self.port)
+        )
+
+    def _response_received(self, data):
+        try:
+            response = json.loads(data.decode())
+            sequence = response.get("seq")
+        except (UnicodeDecodeError, ValueError, AttributeError):
+            logger.warning("Invalid reply from thermometer: {}".format(data))
+            return
+        if sequence is None:
+            # sketch not echoing sequence numbers, oldest request wins
+            sequence = next(iter(self.pending), None)
+        future = self.pending.pop(sequence, None)
+        if future is not None and not future.done():
+            future.set_result(response)
 
     async def request_temperatures(self):
         """Async request of temperatures"""
-        self.thermometer.sendto(b'temps_req', (self.ip, self.port))
-
-        try:
-            request = self.thermometer.recv(4096)
-            logging.info("Requesting temperatures...")
-        except socket.timeout:
-            raise ThermometerLocalTimeout
+        if self.transport is None:
+            await self._connect()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            self.sequence = (self.sequence + 1) % 65536
+            sequence = self.sequence
+            future = loop.create_future()
+            self.pending[sequence] = future
+            self.transport.sendto(json.dumps(
+                {"request": "temps", "seq": sequence}
+            ).encode())
+            try:
+                response = await asyncio.wait_for(future, self.timeout)
+                break
+            except asyncio.TimeoutError:
+                if attempt == self.retries:
+                    raise ThermometerLocalTimeout
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            finally:
+                self.pending.pop(sequence, None)
 
         try:
-            temperature = await self._parse_temperatures(
-                request.decode(), 'celsius'
-            )
-        except (json.decoder.JSONDecodeError, KeyError):
+            temperature = response['celsius']
+        except KeyError:
             raise ThermometerLocalException
 
         return temperature
 
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
 
 class ThermometerDirect():
     """
-    For future implementation of temperature sensor
-    directly attached to RaspberryPi
+    Temperature sensor (DS18B20) directly attached to RaspberryPi
+    through the 1-Wire bus.
+
+    The device is discovered once and looked up again only every
+    discovery_interval seconds or after a failed read.
+    Reads take ~750 ms and run in a small thread pool,
+    not on the event loop.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        device=None,
+        discovery_interval=600,
+        devices_dir='/sys/bus/w1/devices',
+        config_path='/boot/config.txt'
+    ):
+        # 1-Wire device id (28-...), any if None
+        self.device = device
+        self.discovery_interval = discovery_interval
+        self.devices_dir = devices_dir
+        self.config_path = config_path
+        self.path = None
+        self.discovered = None
         if not self.check_pin_configuration():
             raise ConfigurationError(
                 "GPIO pins are not correctly configured"
@@ -74,27 +155,77 @@ class ThermometerDirect():
             )
 
     def check_pin_configuration(self):
-        with open('/boot/config.txt') as f:
+        with open(self.config_path) as f:
             config = f.readlines()
         # check there's a line beginning with dtoverlay=w1-gpio
         if any([x.strip().startswith('dtoverlay=w1-gpio') for x in config]):
 
             return True
 
+    def discover(self):
+        devices = sorted(
+            device for device in os.listdir(self.devices_dir)
+            if device.startswith('28') and self.device in {None, device}
+        )
+        if not devices:
+            raise ThermometerDirectException(
+                "No 1-Wire thermometer found in {}.".format(self.devices_dir)
+            )
+        self.path = os.path.join(self.devices_dir, devices[-1], 'w1_slave')
+        self.discovered = time.monotonic()
+        logger.debug("Discovered 1-Wire thermometer {}.".format(self.path))
+
     async def request_temperatures(self):
-        devices_dir = '/sys/bus/w1/devices'
-        devices = os.listdir(devices_dir)
-        for device in devices:
-            if device.startswith('28'):
-                thermometer = os.path.join(devices_dir, device)
-        data = os.path.join(thermometer, 'w1_slave')
-        with open(data) as f:
-            try:
-                temperature = int(
-                    f.readlines()[-1]
-                    .split('=')[-1]
-                ) / 1000
-            except IndexError as e:
-                raise ThermometerDirectException(e)
+        if (
+            self.path is None
+            or time.monotonic() - self.discovered > self.discovery_interval
+        ):
+            self.discover()
+        loop = asyncio.get_running_loop()
+        try:
+            lines = await loop.run_in_executor(
+                _get_executor(), _read_lines, self.path
+            )
+        except OSError as e:
+            # device may be gone, look for it again at next request
+            self.path = None
+            raise ThermometerDirectException(e)
 
-        return temperature
+        return _parse_w1_slave(lines)
+
+    def close(self):
+        pass
+
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix='w1'
+        )
+    return _executor
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return f.readlines()
+
+
+def _parse_w1_slave(lines):
+    """
+    Parses w1_slave contents, e.g.
+    72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+    72 01 4b 46 7f ff 0e 10 57 t=23125
+    Reads that failed the CRC check (NO) are rejected.
+    """
+    if len(lines) < 2 or not lines[0].strip().endswith('YES'):
+        raise ThermometerDirectException(
+            "CRC check failed: {!r}".format(lines)
+        )
+    try:
+        return int(lines[-1].split('t=')[-1]) / 1000
+    except ValueError as e:
+        raise ThermometerDirectException(e)
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import logging
+import math
+import os
+import shutil
+import time
+
+
+logger_name = 'thermostat.timeseries'
+logger = logging.getLogger(logger_name)
+
+# column name: array typecode
+columns = {
+    'time': 'd',
+    'room_temperature': 'f',
+    'target': 'f',
+    'relay': 'f',
+}
+
+# level name: seconds per sample
+levels = {
+    '1s': 1,
+    '1min': 60,
+    '1h': 3600,
+}
+
+
+class RingBuffer():
+    '''
+    Fixed size, array backed columns. Keeps track of how many
+    of the latest samples were not flushed to disk yet.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.columns = {
+            name: array.array(typecode, [0]) * capacity
+            for name, typecode in columns.items()
+        }
+        # index of next write
+        self.head = 0
+        self.size = 0
+        self.unflushed = 0
+
+    def append(self, sample):
+        for name, value in sample.items():
+            self.columns[name][self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.unflushed = min(self.unflushed + 1, self.capacity)
+
+    def latest(self, n):
+        '''
+        Last n samples, oldest first, as a dict of arrays.
+        '''
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity:
+            return {
+                name: column[start:start + n]
+                for name, column in self.columns.items()
+            }
+        return {
+            name: column[start:] + column[:self.head]
+            for name, column in self.columns.items()
+        }
+
+
+class _Rollup():
+    '''
+    Averages samples falling in the same bucket of step seconds.
+    NaN values are ignored.
+    '''
+
+    def __init__(self, step):
+        self.step = step
+        self.bucket = None
+        self._reset()
+
+    def _reset(self):
+        self.sums = {name: 0.0 for name in columns if name != 'time'}
+        self.counts = {name: 0 for name in self.sums}
+
+    def add(self, sample):
+        '''
+        Returns the averaged sample of the previous bucket
+        when sample starts a new one, None otherwise.
+        '''
+        bucket = sample['time'] // self.step * self.step
+        completed = None
+        if self.bucket is not None and bucket != self.bucket:
+            completed = self.close()
+        self.bucket = bucket
+        for name in self.sums:
+            value = sample[name]
+            if not math.isnan(value):
+                self.sums[name] += value
+                self.counts[name] += 1
+        return completed
+
+    def close(self):
+        sample = {'time': self.bucket}
+        sample.update({
+            name: (
+                self.sums[name] / self.counts[name]
+                if self.counts[name] else math.nan
+            )
+            for name in self.sums
+        })
+        self._reset()
+        return sample
+
+
+class TimeSeriesStore():
+    '''
+    Room temperature, target and relay state history.
+
+    Samples are recorded at a fixed cadence (intervals['sample'],
+    every second by default) in an in-memory ring buffer
+    and rolled up to 1 minute and 1 hour averages (relay becomes
+    the fraction of time the heater was on).
+    flush() appends new samples of every level to columnar segment
+    files, one directory per level and UTC day, one binary file
+    per column: '<path>/<level>/<YYYY-MM-DD>/<column>'.
+    Segments older than each level's retention (seconds) are deleted.
+    '''
+
+    def __init__(self, path, retention, capacity=3600):
+        self.path = path
+        self.retention = retention
+        self.buffers = {level: RingBuffer(capacity) for level in levels}
+        self.rollups = {
+            level: _Rollup(step) for level, step in levels.items()
+            if level != '1s'
+        }
+
+    def record(self, timestamp, room_temperature, target, relay):
+        '''
+        Records a sample. None values are stored as NaN.
+        '''
+        sample = {
+            'time': timestamp,
+            'room_temperature': _to_float(room_temperature),
+            'target': _to_float(target),
+            'relay': _to_float(relay),
+        }
+        for level in levels:
+            if level != '1s':
+                sample = self.rollups[level].add(sample)
+                if sample is None:
+                    break
+            buffer = self.buffers[level]
+            if buffer.unflushed == buffer.capacity:
+                # don't overwrite samples not on disk yet
+                self.flush()
+            buffer.append(sample)
+
+    def flush(self):
+        '''
+        Appends samples not on disk yet to segment files,
+        then applies retention.
+        '''
+        for level, buffer in self.buffers.items():
+            if not buffer.unflushed:
+                continue
+            samples = buffer.latest(buffer.unflushed)
+            # samples may span more than one day
+            days = [_day(timestamp) for timestamp in samples['time']]
+            start = 0
+            while start < len(days):
+                end = bisect.bisect_right(days, days[start], lo=start)
+                segment = os.path.join(self.path, level, days[start])
+                os.makedirs(segment, exist_ok=True)
+                _repair_segment(segment)
+                for name, column in samples.items():
+                    with open(os.path.join(segment, name), 'ab') as f:
+                        column[start:end].tofile(f)
+                start = end
+            buffer.unflushed = 0
+        self.apply_retention()
+
+    def apply_retention(self, now=None):
+        now = time.time() if now is None else now
+        for level in levels:
+            level_path = os.path.join(self.path, level)
+            if not os.path.isdir(level_path):
+                continue
+            # whole days only, all samples of older days are expired
+            oldest = _day(now - self.retention[level])
+            for day in os.listdir(level_path):
+                if day < oldest:
+                    shutil.rmtree(os.path.join(level_path, day))
+                    logger.debug('Deleted {} segment {}.'.format(level, day))
+
+    def query(self, start, end, level='1s'):
+        '''
+        Samples with start <= time <= end (epoch seconds)
+        at given resolution, as a dict of arrays by column.
+        '''
+        result = {
+            name: array.array(typecode) for name, typecode in columns.items()
+        }
+        level_path = os.path.join(self.path, level)
+        if os.path.isdir(level_path):
+            first, last = _day(start), _day(end)
+            for day in sorted(os.listdir(level_path)):
+                if first <= day <= last:
+                    _extend(
+                        result,
+                        _read_segment(os.path.join(level_path, day)),
+                        start,
+                        end
+                    )
+        buffer = self.buffers[level]
+        _extend(result, buffer.latest(buffer.unflushed), start, end)
+        return result
+
+    def close(self):
+        for level, rollup in self.rollups.items():
+            if rollup.bucket is not None:
+                # partial bucket, better than losing it
+                self.buffers[level].append(rollup.close())
+                rollup.bucket = None
+        self.flush()
+
+
+def _to_float(value):
+    if value is None:
+        return math.nan
+    return float(value)
+
+
+def _day(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _repair_segment(segment):
+    '''
+    Truncates columns to the same number of samples before appending,
+    so that a flush torn by a crash doesn't misalign later samples.
+    '''
+    sizes = {}
+    for name, typecode in columns.items():
+        path = os.path.join(segment, name)
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        sizes[path] = (size, array.array(typecode).itemsize)
+    samples = min(size // itemsize for size, itemsize in sizes.values())
+    for path, (size, itemsize) in sizes.items():
+        if size != samples * itemsize:
+            logger.warning('Truncating torn column {} to {} samples.'.format(
+                path, samples
+            ))
+            os.truncate(path, samples * itemsize)
+
+
+def _read_segment(segment):
+    samples = {}
+    for name, typecode in columns.items():
+        column = array.array(typecode)
+        path = os.path.join(segment, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            # whole samples only
+            column.frombytes(data[:len(data) // column.itemsize
+                                  * column.itemsize])
+        samples[name] = column
+    # a crash during flush may leave columns of different length
+    size = min(len(column) for column in samples.values())
+    return {name: column[:size] for name, column in samples.items()}
+
+
+def _extend(result, samples, start, end):
+    times = samples['time']
+    first = bisect.bisect_left(times, start)
+    last = bisect.bisect_right(times, end)
+    for name, column in samples.items():
+        result[name].extend(column[first:last])
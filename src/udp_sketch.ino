@@ -92,6 +92,14 @@ void loop() {
     }
     Serial.printf("UDP packet contents: %s\n", incomingPacket);
 
+    // echo the request's sequence number so the reply can be matched
+    StaticJsonDocument<64> requestJson;
+    if (!deserializeJson(requestJson, incomingPacket) && requestJson.containsKey("seq"))
+    {
+      temperatureJson["seq"] = requestJson["seq"];
+      serializeJson(temperatureJson, buffer);
+    }
+
     // send back a reply, to the IP address and port we got the packet from
     Udp.beginPacket(Udp.remoteIP(), Udp.remotePort());
     Udp.write(buffer);
@@ -1,12 +1,11 @@
 #!/usr/bin/python3
 
 import datetime
-import json
 import logging
-import os
 import time
 
 from exceptions import *
+from log_handler import LogHandler
 
 
 logger_name = 'thermostat'
@@ -36,13 +35,43 @@ def get_loglevel(level):
     return loglevel[level.lower()]
 
 
+class SystemClock():
+    '''
+    Wall clock and monotonic clock the thermostat runs on.
+    '''
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+
+# replaced by simulations with a virtual clock, see set_clock
+clock = SystemClock()
+
+
+def set_clock(new_clock):
+    '''
+    Makes get_now and everything timed through util.clock
+    use new_clock. Returns the previous clock.
+    '''
+    global clock
+    previous_clock = clock
+    clock = new_clock
+    return previous_clock
+
+
 def get_now():
     '''
     Get current weekday, hour, minutes, seconds.
     Return them all in a dictionary together with
     total seconds and formatted time.
     '''
-    current_time = datetime.datetime.now()
+    current_time = clock.now()
     current_weekday = days_of_week[current_time.weekday()]
     current_day = current_time.day
     current_hour = current_time.hour
@@ -73,19 +102,7 @@ def get_now():
 
 
 def write_log(log_path, data):
-    if not os.path.isfile(log_path) or not os.stat(log_path).st_size:
-        with open(log_path, 'w') as f:
-            f.write(json.dumps([data], indent=2))
-            f.write('\n')
-    else:
-        with open(log_path) as f:
-            log_file = json.load(f)
-        log_file.append(data)
-        with open(log_path, 'w') as f:
-            f.write(json.dumps(log_file, indent=2))
-            f.write('\n')
-
-    return 'Wrote log to file.'
+    return LogHandler(log_path).write_log(data)
 
 
 def format_seconds(seconds):
@@ -160,15 +177,6 @@ def check_same_day(last, current):
     return False
 
 
-def stop_expired(current, stop, stop_time) -> bool:
-    """
-    Returns True is stop time is expired
-    """
-    time_since_stop = current["datetime"] - stop
-
-    return time_since_stop.total_seconds() > stop_time
-
-
 def increment_time_elapsed(settings, n):
     time_elapsed_restore = datetime.datetime.strptime(
         settings.get('time_elapsed', '0:00:00'), '%H:%M:%S'
@@ -183,17 +191,3 @@ def increment_time_elapsed(settings, n):
     time_elapsed += n
 
     return format_seconds(time_elapsed)
-
-
-def compute_differences(settings, settings_prev):
-    """
-    Given two settings dictionary from different cycles,
-    computes difference in every field and returns
-    a new dictionary having identical fields but boolean value.
-
-    True if there was a difference, False else
-    """
-    return {
-        k: True if v != settings_prev.get(k) else False
-        for k, v in settings.items()
-    }